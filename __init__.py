@@ -1,17 +1,32 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import assign
 from . import configuration
+from . import job
+from . import location
 from . import move
+from . import party
+from . import plan
 from . import shipment
 
 
 def register():
     Pool.register(
         configuration.Configuration,
+        location.Location,
         move.Move,
+        party.Party,
         shipment.ShipmentOut,
         shipment.ShipmentOutAssignWizardStart,
+        assign.ShipmentOutAssignPending,
+        assign.ShipmentOutAssignBlocked,
+        assign.ShipmentOutAssignRun,
+        assign.ShipmentOutAssignCheckpoint,
+        plan.ShipmentOutAssignPlan,
+        plan.ShipmentOutAssignPlanLine,
+        job.ShipmentOutAssignJob,
+        job.ShipmentOutAssignJobShipment,
         module='stock_shipment_out_autoassign', type_='model')
     Pool.register(
         shipment.ShipmentOutAssignWizard,
@@ -0,0 +1,421 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+import datetime
+import logging
+import threading
+
+from trytond.model import ModelSQL, ModelView, fields, Unique
+from trytond.pool import Pool
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .tools import commit
+
+__all__ = ['ShipmentOutAssignPending', 'ShipmentOutAssignBlocked',
+    'ShipmentOutAssignRun', 'ShipmentOutAssignCheckpoint', 'assign_run',
+    'recorded', 'phase', 'count']
+logger = logging.getLogger(__name__)
+
+PHASES = ['query', 'products_by_location', 'fit', 'assign_try', 'commit',
+    'lock_wait']
+COUNTS = ['candidates', 'assigned']
+_local = threading.local()
+
+
+class RunRecorder(object):
+    'Timings and counts of an assign run'
+
+    def __init__(self, process):
+        self.process = process
+        self.start = datetime.datetime.now()
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+
+
+@contextmanager
+def assign_run(process):
+    '''
+    Record the timings and counts of an assign process and save them as a
+    stock.shipment.out.assign.run if it had candidate shipments. Nested runs
+    of the same thread are accounted in the outer one.
+    '''
+    if getattr(_local, 'run', None):
+        yield _local.run
+        return
+    _local.run = recorder = RunRecorder(process)
+    try:
+        yield recorder
+    finally:
+        _local.run = None
+    # Calls that did not try any shipment, like most waits, are not recorded
+    if recorder.counts['candidates']:
+        Pool().get('stock.shipment.out.assign.run').save_recorder(recorder)
+
+
+def recorded(process):
+    'Decorator to record the calls of the function as assign runs'
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with assign_run(process):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name):
+    'Add the time spent in the block to the phase of the current run'
+    recorder = getattr(_local, 'run', None)
+    if not recorder:
+        yield
+        return
+    start = time()
+    try:
+        yield
+    finally:
+        recorder.timings[name] += time() - start
+
+
+def count(name, value=1):
+    'Add value to the count of the current run'
+    recorder = getattr(_local, 'run', None)
+    if recorder:
+        recorder.counts[name] += value
+
+
+class ShipmentOutAssignPending(ModelSQL):
+    'Shipment Out Assign Pending'
+    __name__ = 'stock.shipment.out.assign.pending'
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        select=True, ondelete='CASCADE')
+
+    @classmethod
+    def get_stock_increases(cls, moves):
+        '''
+        Returns the (warehouse id, product id) pairs of the moves that enter
+        the storage location of a warehouse from outside of it.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        cursor = Transaction().connection.cursor()
+
+        move = Move.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+        warehouse = Location.__table__()
+        storage = Location.__table__()
+
+        def inside(location):
+            return ((location.left >= storage.left)
+                & (location.right <= storage.right))
+
+        query = (move
+            .join(from_location,
+                condition=move.from_location == from_location.id)
+            .join(to_location, condition=move.to_location == to_location.id)
+            .join(warehouse, condition=warehouse.type == 'warehouse')
+            .join(storage,
+                condition=warehouse.storage_location == storage.id))
+        pairs = set()
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*query.select(warehouse.id, move.product,
+                    where=(reduce_ids(move.id, sub_ids)
+                        & (move.state == 'done')
+                        & inside(to_location)
+                        & ~inside(from_location)),
+                    group_by=(warehouse.id, move.product)))
+            pairs.update(cursor.fetchall())
+        return pairs
+
+    @classmethod
+    def add_moves(cls, moves):
+        '''
+        Record the stock increases of the done moves and unblock the shipments
+        waiting for them
+        '''
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        pairs = cls.get_stock_increases(moves)
+        if not pairs:
+            return
+        Blocked.unblock(pairs)
+        # Not deduplicated with the existing pendings as they may be being
+        # processed and then deleted
+        cls.create([{
+                    'warehouse': warehouse_id,
+                    'product': product_id,
+                    } for warehouse_id, product_id in pairs])
+
+    @classmethod
+    @recorded('pending')
+    def process(cls, args=None):
+        '''
+        This method is intended to be called from ir.cron
+        Try to assign the waiting shipments of the warehouses that need the
+        products whose stock has increased.
+        '''
+        # lock imports phase from this module
+        from .lock import warehouse_lock
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        pendings = defaultdict(list)
+        for pending in cls.search([]):
+            pendings[pending.warehouse.id].append(pending)
+
+        for warehouse_id, warehouse_pendings in pendings.items():
+            product_ids = set(p.product.id for p in warehouse_pendings)
+            # The lock is reentrant so assign_try_warehouse gets it
+            with warehouse_lock([warehouse_id],
+                    config.assign_lock_timeout) as locked:
+                if not locked:
+                    # Keep the pendings for the next call
+                    continue
+                logger.info('Pending Try Assign. Warehouse %s: %s products'
+                    % (warehouse_id, len(product_ids)))
+                ShipmentOut.assign_try_warehouse(warehouse_id, [
+                        ('state', '=', 'waiting'),
+                        ('moves.product', 'in', list(product_ids)),
+                        ('moves.state', '=', 'draft'),
+                        ])
+                # Only the pendings read are removed, the ones added meanwhile
+                # are processed by the next call
+                cls.delete(warehouse_pendings)
+                with phase('commit'):
+                    commit()
+
+
+class ShipmentOutAssignBlocked(ModelSQL):
+    'Shipment Out Assign Blocked'
+    __name__ = 'stock.shipment.out.assign.blocked'
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, select=True, ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        select=True, ondelete='CASCADE')
+
+    @classmethod
+    def block(cls, requirements, ledger=None):
+        '''
+        Record the (location, product) pairs that block the shipments: the
+        ones whose quantity is not available in the ledger or, without ledger
+        or if all are available, all the pairs of the shipment.
+        requirements: {shipment id: {(location id, product id): quantity}}
+        '''
+        rows = set()
+        for shipment_id, needs in requirements.items():
+            keys = [k for k, q in needs.items()
+                if ledger and q > ledger.available(k)] or list(needs)
+            rows.update((shipment_id, k[0], k[1]) for k in keys)
+        cls.unblock_shipments(list(requirements))
+        cls.create([{
+                    'shipment': shipment_id,
+                    'location': location_id,
+                    'product': product_id,
+                    } for shipment_id, location_id, product_id in rows])
+
+    @classmethod
+    def unblock(cls, pairs):
+        '''
+        Remove all the blocks of the shipments blocked by any of the
+        (warehouse id, product id) pairs whose stock has increased in the
+        storage location of the warehouse.
+        '''
+        Location = Pool().get('stock.location')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        blocking = cls.__table__()
+        location = Location.__table__()
+
+        products = defaultdict(set)
+        for warehouse_id, product_id in pairs:
+            products[warehouse_id].add(product_id)
+        subtrees = Location.get_storage_subtrees(products)
+        query = blocking.join(location,
+            condition=blocking.location == location.id)
+        for warehouse_id, product_ids in products.items():
+            if warehouse_id not in subtrees:
+                continue
+            subtree = subtrees[warehouse_id]
+            for sub_ids in grouped_slice(product_ids):
+                shipments = query.select(blocking.shipment,
+                    where=(reduce_ids(blocking.product, sub_ids)
+                        & (location.left >= subtree.left)
+                        & (location.right <= subtree.right)))
+                cursor.execute(*table.delete(
+                        where=table.shipment.in_(shipments)))
+
+    @classmethod
+    def get_stock_releases(cls, moves):
+        '''
+        Returns the (warehouse id, product id) pairs of the assigned moves
+        that leave the storage location of a warehouse, whose stock is
+        released if they are cancelled or reset to draft.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        cursor = Transaction().connection.cursor()
+
+        move = Move.__table__()
+        from_location = Location.__table__()
+        warehouse = Location.__table__()
+        storage = Location.__table__()
+
+        query = (move
+            .join(from_location,
+                condition=move.from_location == from_location.id)
+            .join(warehouse, condition=warehouse.type == 'warehouse')
+            .join(storage,
+                condition=warehouse.storage_location == storage.id))
+        pairs = set()
+        for sub_ids in grouped_slice([m.id for m in moves]):
+            cursor.execute(*query.select(warehouse.id, move.product,
+                    where=(reduce_ids(move.id, sub_ids)
+                        & (move.state == 'assigned')
+                        & (from_location.left >= storage.left)
+                        & (from_location.right <= storage.right)),
+                    group_by=(warehouse.id, move.product)))
+            pairs.update(cursor.fetchall())
+        return pairs
+
+    @classmethod
+    def unblock_shipments(cls, shipment_ids):
+        'Remove the blocks of the shipments'
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        for sub_ids in grouped_slice(shipment_ids):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.shipment, sub_ids)))
+
+
+class ShipmentOutAssignRun(ModelSQL, ModelView):
+    'Shipment Out Assign Run'
+    __name__ = 'stock.shipment.out.assign.run'
+    process = fields.Selection([
+            ('scheduler', 'Scheduler'),
+            ('pending', 'Pending Scheduler'),
+            ('wait', 'Wait'),
+            ('try_assign', 'Try Assign'),
+            ('wizard', 'Wizard'),
+            ('autoassign', 'Autoassign Received Moves'),
+            ('plan', 'Apply Assign Plan'),
+            ], 'Process', required=True, readonly=True, select=True)
+    start = fields.DateTime('Start', required=True, readonly=True)
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help="In seconds.")
+    candidates = fields.Integer('Candidates', readonly=True)
+    assigned = fields.Integer('Assigned', readonly=True)
+    skipped = fields.Integer('Skipped', readonly=True)
+    query_time = fields.Float('Query Time', digits=(16, 3), readonly=True)
+    products_by_location_time = fields.Float('Products by Location Time',
+        digits=(16, 3), readonly=True)
+    fit_time = fields.Float('Fit Time', digits=(16, 3), readonly=True)
+    assign_try_time = fields.Float('Assign Try Time', digits=(16, 3),
+        readonly=True)
+    commit_time = fields.Float('Commit Time', digits=(16, 3), readonly=True)
+    lock_wait_time = fields.Float('Lock Wait Time', digits=(16, 3),
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentOutAssignRun, cls).__setup__()
+        cls._order.insert(0, ('start', 'DESC'))
+
+    @classmethod
+    def save_recorder(cls, recorder):
+        values = {
+            'process': recorder.process,
+            'start': recorder.start,
+            'duration': (datetime.datetime.now()
+                - recorder.start).total_seconds(),
+            }
+        for name in PHASES:
+            values[name + '_time'] = recorder.timings[name]
+        for name in COUNTS:
+            values[name] = recorder.counts[name]
+        values['skipped'] = max(
+            values['candidates'] - values['assigned'], 0)
+        with Transaction().set_user(0):
+            cls.create([values])
+
+
+class ShipmentOutAssignCheckpoint(ModelSQL, ModelView):
+    'Shipment Out Assign Checkpoint'
+    __name__ = 'stock.shipment.out.assign.checkpoint'
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        readonly=True, ondelete='CASCADE',
+        domain=[('type', '=', 'warehouse')])
+    last_write_date = fields.DateTime('Last Write Date', readonly=True,
+        help="Write date of the last shipment processed by the scheduler.")
+    last_id = fields.Integer('Last ID', readonly=True,
+        help="ID of the last shipment processed by the scheduler.")
+    state = fields.Selection([
+            ('running', 'Running'),
+            ('paused', 'Paused'),
+            ('done', 'Done'),
+            ], 'State', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentOutAssignCheckpoint, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('warehouse_uniq', Unique(t, t.warehouse),
+                'Only one checkpoint is allowed by warehouse.'),
+            ]
+
+    @staticmethod
+    def default_state():
+        return 'done'
+
+    @staticmethod
+    def default_last_id():
+        return 0
+
+    @classmethod
+    def get_checkpoint(cls, warehouse_id, since=None):
+        '''
+        Returns the checkpoint of the warehouse, created from since if it does
+        not exist yet.
+        '''
+        with Transaction().set_user(0):
+            checkpoints = cls.search([
+                    ('warehouse', '=', warehouse_id),
+                    ], limit=1)
+            if checkpoints:
+                return checkpoints[0]
+            checkpoint, = cls.create([{
+                        'warehouse': warehouse_id,
+                        'last_write_date': since,
+                        }])
+            return checkpoint
+
+    @property
+    def after(self):
+        'The (write date, id) key to resume from'
+        if self.last_write_date:
+            return (self.last_write_date, self.last_id or 0)
+
+    def save_progress(self, state, after=None):
+        '''
+        Save the state of the checkpoint and, if given, the (write date, id)
+        of the last shipment processed.
+        '''
+        values = {'state': state}
+        if after:
+            values['last_write_date'], values['last_id'] = after
+        with Transaction().set_user(0):
+            self.write([self], values)
@@ -0,0 +1,200 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import namedtuple
+import datetime
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .assign import phase
+from .tools import products_by_location
+
+__all__ = ['Ledger', 'Candidate', 'STRATEGIES', 'allocate',
+    'allocate_partial']
+
+
+class Ledger(object):
+    '''
+    In memory stock availability by (location, product).
+    It is loaded once and decremented as quantities are taken, so it can be
+    used to discard shipments that can not be assigned before trying them.
+    It can be extended with new locations and products keeping the
+    quantities already taken.
+    If lot_aware, the quantities by (location, product, lot) are also kept
+    and the (location, product) ones only sum the lots not expiring before
+    expiry_date.
+    If deduct_reserved, the quantities reserved by the assigned moves leaving
+    each location are deducted, it is meant for ledgers without childs.
+    '''
+
+    def __init__(self, quantities=None, with_childs=True, stock_assign=True,
+            lot_aware=False, expiry_date=None, deduct_reserved=False):
+        self.quantities = dict(quantities or {})
+        self.with_childs = with_childs
+        self.stock_assign = stock_assign
+        self.deduct_reserved = deduct_reserved
+        self.lot_aware = lot_aware
+        self.expiry_date = expiry_date
+        # The quantities of all the pairs of these sets are loaded
+        self.location_ids = set()
+        self.product_ids = set()
+
+    def extend(self, location_ids, product_ids):
+        'Load the quantities of the pairs not loaded yet'
+        new_location_ids = set(location_ids) - self.location_ids
+        new_product_ids = set(product_ids) - self.product_ids
+        self.location_ids |= new_location_ids
+        self.product_ids |= new_product_ids
+        self._load(new_location_ids, self.product_ids)
+        self._load(self.location_ids - new_location_ids, new_product_ids)
+
+    def _load(self, location_ids, product_ids):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Date = pool.get('ir.date')
+
+        if not location_ids or not product_ids:
+            return
+        today = Date.today()
+        # stock_assign deducts the quantities of the assigned moves as the
+        # core assignation does
+        grouping = ('product', 'lot') if self.lot_aware else ('product',)
+        with Transaction().set_context(forecast=False,
+                stock_assign=self.stock_assign, stock_date_end=today), \
+                phase('products_by_location'):
+            pbl = products_by_location(location_ids, product_ids,
+                with_childs=self.with_childs, grouping=grouping)
+        if self.lot_aware:
+            pbl = self._lot_quantities(pbl)
+        # Only the pairs with stock are kept, the others are available as 0
+        self.quantities.update(
+            (k, q) for k, q in pbl.items() if q and len(k) == 2)
+        if self.deduct_reserved:
+            reserved = Move.get_reserved_quantities(product_ids,
+                location_ids=location_ids)
+            for key, quantity in reserved.items():
+                self.quantities[key] = self.available(key) - quantity
+        if self.lot_aware:
+            self.quantities.update(
+                (k, q) for k, q in pbl.items() if q and len(k) == 3)
+
+    def _lot_quantities(self, pbl):
+        '''
+        Returns the quantities by (location, product, lot) without the
+        expired lots and their sum by (location, product)
+        '''
+        Lot = Pool().get('stock.lot')
+
+        expired = set()
+        if self.expiry_date and 'expiration_date' in Lot._fields:
+            lot_ids = list(set(k[2] for k in pbl if k[2]))
+            expired = set(l.id for l in Lot.search([
+                        ('id', 'in', lot_ids),
+                        ('expiration_date', '!=', None),
+                        ('expiration_date', '<', self.expiry_date),
+                        ]))
+        quantities = {}
+        for (location_id, product_id, lot_id), quantity in pbl.items():
+            if lot_id in expired:
+                continue
+            if lot_id:
+                quantities[(location_id, product_id, lot_id)] = quantity
+            key = (location_id, product_id)
+            quantities[key] = quantities.get(key, 0) + quantity
+        return quantities
+
+    def available(self, key):
+        return self.quantities.get(key, 0)
+
+    def fits(self, requirements):
+        return all(quantity <= self.available(key)
+            for key, quantity in requirements.items())
+
+    def take(self, requirements):
+        for key, quantity in requirements.items():
+            self.quantities[key] = self.available(key) - quantity
+
+
+# Shipments, or moves, competing for the stock of the ledger
+Candidate = namedtuple('Candidate',
+    ['id', 'planned_date', 'priority', 'requirements'])
+
+
+def _date_key(candidate):
+    return (candidate.planned_date or datetime.date.max, candidate.id)
+
+
+def fifo(candidates, ledger):
+    'First planned first served'
+    return sorted(candidates, key=_date_key)
+
+
+def max_shipments(candidates, ledger):
+    '''
+    Maximize the number of fully served candidates: the ones using the
+    smallest share of the available stock are served first, those that can
+    not fit are left at the end.
+    '''
+    def key(candidate):
+        share = 0
+        for location_product, quantity in candidate.requirements.items():
+            available = ledger.available(location_product)
+            if quantity > available:
+                return (1, 0) + _date_key(candidate)
+            if available:
+                share += quantity / float(available)
+        return (0, share) + _date_key(candidate)
+    return sorted(candidates, key=key)
+
+
+def party_priority(candidates, ledger):
+    'Highest party priority first and then first planned'
+    return sorted(candidates,
+        key=lambda c: (-(c.priority or 0),) + _date_key(c))
+
+
+STRATEGIES = {
+    'fifo': fifo,
+    'max_shipments': max_shipments,
+    'party_priority': party_priority,
+    }
+
+
+def allocate(candidates, ledger, strategy=fifo):
+    '''
+    Returns the candidates that fit in the ledger in the order of the
+    strategy, taking their quantities from it.
+    '''
+    allocated = []
+    with phase('fit'):
+        for candidate in strategy(candidates, ledger):
+            if ledger.fits(candidate.requirements):
+                ledger.take(candidate.requirements)
+                allocated.append(candidate)
+    return allocated
+
+
+def allocate_partial(candidates, parts, ledger, strategy=fifo):
+    '''
+    Same as allocate but the parts of the candidates that do not fit as a
+    whole take the quantity available, up to their requirements, so they are
+    split when assigned.
+    parts: {candidate id: [(part id, requirements)]}
+    Returns the allocated candidates and the ids of the parts allocated of
+    the other candidates.
+    '''
+    allocated, allocated_parts = [], []
+    with phase('fit'):
+        for candidate in strategy(candidates, ledger):
+            if ledger.fits(candidate.requirements):
+                ledger.take(candidate.requirements)
+                allocated.append(candidate)
+                continue
+            for part_id, requirements in parts.get(candidate.id, []):
+                available = min(ledger.available(k) for k in requirements)
+                if available <= 0:
+                    continue
+                ledger.take(dict((k, min(q, available))
+                        for k, q in requirements.items()))
+                allocated_parts.append(part_id)
+    return allocated, allocated_parts
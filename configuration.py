@@ -2,6 +2,7 @@
 # copyright notices and license terms.
 from trytond.model import fields
 from trytond.pool import PoolMeta
+from trytond.pyson import Eval
 
 __all__ = ['Configuration']
 
@@ -14,6 +15,58 @@ class Configuration:
     slice_try_assign = fields.Integer('Cron slice Try assign',
         help=("Number of blocs of shipments to try assign before do the "
             "commit. If 0 or null it will be all."))
+    autoassign_single_query = fields.Boolean('Autoassign in a single query',
+        help=("Compute the output moves to assign when receiving shipments "
+            "in a single query in the database."))
+    assign_lock_timeout = fields.Integer('Assign lock timeout',
+        help=("Seconds to wait for another process assigning shipments of "
+            "the same warehouse before skipping it."))
+    assign_workers = fields.Integer('Cron assign workers',
+        help=("Number of warehouses to try assign in parallel by the cron, "
+            "each one in its own transaction. If 0 or null it will be 1."))
+    assign_page_size = fields.Integer('Assign page size',
+        help=("Number of waiting shipments read at once by the cron and the "
+            "wizard. If 0 or null all will be read at once."))
+    assign_time_budget = fields.Integer('Cron assign time budget',
+        help=("Seconds the cron spends assigning shipments in a call, the "
+            "next call continues where it stopped. If 0 or null there is no "
+            "limit."))
+    try_assign_background = fields.Integer('Background Try assign from',
+        help=("Number of selected shipments from which the Try Assign button "
+            "creates an assign job run in background by the cron. If 0 or "
+            "null it is never run in background."))
+    assign_lot_aware = fields.Boolean('Lot aware assign',
+        help=("Check the stock by lot before trying to assign shipments. "
+            "Only used if the moves have lots."))
+    lot_expiry_margin = fields.Integer('Lot expiry margin',
+        states={
+            'invisible': ~Eval('assign_lot_aware'),
+            },
+        depends=['assign_lot_aware'],
+        help=("Days from today before which expiring lots are not taken "
+            "into account by the lot aware assign."))
+    allocation_strategy = fields.Selection([
+            ('fifo', 'First Planned First Served'),
+            ('max_shipments', 'Maximize Served Shipments'),
+            ('party_priority', 'Party Priority'),
+            ], 'Allocation Strategy',
+        help="Order to serve the shipments when there is not enough stock.")
+    autoassign_mode = fields.Selection([
+            ('immediate', 'Immediate'),
+            ('deferred', 'Deferred'),
+            ], 'Autoassign Mode',
+        help=("Immediate: assign the output shipments when the supplier "
+            "shipments are done.\n"
+            "Deferred: record the received products and assign the output "
+            "shipments in the pending scheduler."))
+    partial_assign_policy = fields.Selection([
+            ('whole', 'Whole Shipments'),
+            ('partial', 'Allow Partial'),
+            ], 'Partial Assign Policy',
+        help=("Whole Shipments: received products only assign the output "
+            "shipments whose moves can all be served.\n"
+            "Allow Partial: the moves that can be served of the other "
+            "shipments are also assigned, splitting them if needed."))
 
     @staticmethod
     def default_try_wait2assign():
@@ -22,3 +75,31 @@ class Configuration:
     @staticmethod
     def default_slice_try_assign():
         return 10
+
+    @staticmethod
+    def default_assign_lock_timeout():
+        return 10
+
+    @staticmethod
+    def default_assign_workers():
+        return 1
+
+    @staticmethod
+    def default_assign_page_size():
+        return 1000
+
+    @staticmethod
+    def default_allocation_strategy():
+        return 'fifo'
+
+    @staticmethod
+    def default_autoassign_mode():
+        return 'immediate'
+
+    @staticmethod
+    def default_partial_assign_policy():
+        return 'whole'
+
+    @staticmethod
+    def default_try_assign_background():
+        return 50
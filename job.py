@@ -0,0 +1,153 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+from .assign import recorded, phase
+from .lock import warehouse_lock
+from .tools import commit, rollback
+
+__all__ = ['ShipmentOutAssignJob', 'ShipmentOutAssignJobShipment']
+logger = logging.getLogger(__name__)
+
+
+class ShipmentOutAssignJob(ModelSQL, ModelView):
+    'Shipment Out Assign Job'
+    __name__ = 'stock.shipment.out.assign.job'
+    user = fields.Many2One('res.user', 'User', readonly=True)
+    shipments = fields.Many2Many('stock.shipment.out.assign.job-shipment',
+        'job', 'shipment', 'Shipments', readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pending'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, select=True)
+    total = fields.Integer('Total', readonly=True)
+    processed = fields.Integer('Processed', readonly=True)
+    assigned = fields.Integer('Assigned', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentOutAssignJob, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    @staticmethod
+    def default_assigned():
+        return 0
+
+    @classmethod
+    def submit(cls, shipments):
+        'Create a job to try to assign the shipments in background'
+        transaction = Transaction()
+        user_id = transaction.user
+        with transaction.set_user(0):
+            job, = cls.create([{
+                        'user': user_id,
+                        'shipments': [('add', [s.id for s in shipments])],
+                        'total': len(shipments),
+                        }])
+        return job
+
+    @classmethod
+    def process(cls, args=None):
+        '''
+        This method is intended to be called from ir.cron
+        Run the pending jobs and resume the ones interrupted. A job raising
+        an error is rolled back and set as failed so the next ones still run.
+        '''
+        for job in cls.search([
+                    ('state', 'in', ['pending', 'running']),
+                    ], order=[('create_date', 'ASC')]):
+            try:
+                with Transaction().set_context(_check_access=False):
+                    job.run()
+                commit()
+            except Exception:
+                logger.error('Error running assign job %s.', job.id,
+                    exc_info=True)
+                rollback()
+                cls.write([cls(job.id)], {'state': 'failed'})
+                commit()
+
+    @recorded('try_assign')
+    def run(self):
+        '''
+        Try to assign the waiting shipments of the job with the stock computed
+        in bulk, as the scheduler does, committing the progress after each
+        bloc.
+        '''
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        domain = [
+            ('id', 'in', [s.id for s in self.shipments]),
+            ('state', '=', 'waiting'),
+            ]
+        warehouse_ids = set(s.warehouse.id for s in self.shipments)
+        with Transaction().set_context(dblock=False), \
+                warehouse_lock(warehouse_ids,
+                    config.assign_lock_timeout) as locked:
+            if set(locked) != warehouse_ids:
+                # Try again in the next call
+                return
+            # Shipments no longer waiting were processed before
+            processed = self.total - ShipmentOut.search_count(domain)
+            assigned = self.assigned
+            self.write([self], {
+                    'state': 'running',
+                    'processed': processed,
+                    })
+            with phase('commit'):
+                commit()
+
+            ledger = ShipmentOut.get_ledger()
+            slice_try_assign = config.slice_try_assign
+            for page in ShipmentOut.search_allocation_pages(domain,
+                    config.assign_page_size):
+                shipments = ShipmentOut.get_satisfiable(page, ledger)
+                processed += len(page) - len(shipments)
+                for sub_shipments in grouped_slice(shipments,
+                        slice_try_assign or len(shipments)):
+                    sub_shipments = list(sub_shipments)
+                    sub_assigned, _ = ShipmentOut.assign_try_bisect(
+                        sub_shipments)
+                    processed += len(sub_shipments)
+                    assigned += len(sub_assigned)
+                    self.write([self], {
+                            'processed': processed,
+                            'assigned': assigned,
+                            })
+                    with phase('commit'):
+                        commit()
+            self.write([self], {
+                    'state': 'done',
+                    'processed': self.total,
+                    'assigned': assigned,
+                    })
+            logger.info('Job %s Try Assign. Assigned: %s of %s'
+                % (self.id, assigned, self.total))
+
+
+class ShipmentOutAssignJobShipment(ModelSQL):
+    'Shipment Out Assign Job - Shipment'
+    __name__ = 'stock.shipment.out.assign.job-shipment'
+    _table = 'stock_shipment_out_assign_job_shipment_rel'
+    job = fields.Many2One('stock.shipment.out.assign.job', 'Job',
+        required=True, select=True, ondelete='CASCADE')
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, ondelete='CASCADE')
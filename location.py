@@ -0,0 +1,95 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import namedtuple
+
+from trytond.cache import Cache
+from trytond.pool import PoolMeta
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['Location']
+
+# Storage location of a warehouse with its nested set bounds and the ids of
+# all its descendants, itself included
+StorageSubtree = namedtuple('StorageSubtree',
+    ['storage', 'left', 'right', 'location_ids'])
+
+
+class Location:
+    __name__ = 'stock.location'
+    __metaclass__ = PoolMeta
+    _storage_subtree_cache = Cache(
+        'stock_location.storage_subtree', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        locations = super(Location, cls).create(vlist)
+        cls._storage_subtree_cache.clear()
+        return locations
+
+    @classmethod
+    def write(cls, *args):
+        super(Location, cls).write(*args)
+        cls._storage_subtree_cache.clear()
+
+    @classmethod
+    def delete(cls, locations):
+        super(Location, cls).delete(locations)
+        cls._storage_subtree_cache.clear()
+
+    @classmethod
+    def get_storage_subtrees(cls, warehouse_ids):
+        '''
+        Returns the storage subtree of each warehouse:
+            {warehouse id: StorageSubtree}
+        It is cached until a location is modified.
+        '''
+        cursor = Transaction().connection.cursor()
+
+        subtrees = {}
+        missing = []
+        for warehouse_id in set(warehouse_ids):
+            subtree = cls._storage_subtree_cache.get(warehouse_id)
+            if subtree is None:
+                missing.append(warehouse_id)
+            else:
+                subtrees[warehouse_id] = StorageSubtree(*subtree)
+
+        warehouse = cls.__table__()
+        storage = cls.__table__()
+        child = cls.__table__()
+        query = (warehouse
+            .join(storage, condition=warehouse.storage_location == storage.id)
+            .join(child, condition=(
+                    (child.left >= storage.left)
+                    & (child.right <= storage.right))))
+        rows = {}
+        for sub_ids in grouped_slice(missing):
+            cursor.execute(*query.select(
+                    warehouse.id, storage.id, storage.left, storage.right,
+                    child.id,
+                    where=reduce_ids(warehouse.id, sub_ids)))
+            for warehouse_id, storage_id, left, right, child_id in cursor:
+                rows.setdefault(warehouse_id,
+                    (storage_id, left, right, []))[3].append(child_id)
+        for warehouse_id, (storage_id, left, right, child_ids) in (
+                rows.items()):
+            subtree = StorageSubtree(storage_id, left, right,
+                tuple(sorted(child_ids)))
+            cls._storage_subtree_cache.set(warehouse_id, tuple(subtree))
+            subtrees[warehouse_id] = subtree
+        return subtrees
+
+    @staticmethod
+    def storage_subtree_condition(location, warehouse, subtrees):
+        '''
+        Returns the SQL condition of the location table being inside the
+        storage subtree of the warehouse column.
+        '''
+        condition = None
+        for warehouse_id, subtree in subtrees.items():
+            inside = ((warehouse == warehouse_id)
+                & (location.left >= subtree.left)
+                & (location.right <= subtree.right))
+            condition = inside if condition is None else condition | inside
+        return condition
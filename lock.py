@@ -0,0 +1,87 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from contextlib import contextmanager
+from time import sleep, time
+import logging
+import weakref
+
+from trytond import backend
+from trytond.transaction import Transaction
+
+from .assign import phase
+
+__all__ = ['warehouse_lock', 'relock']
+logger = logging.getLogger(__name__)
+
+# First key of the advisory locks of the module, the second one is the
+# warehouse id
+LOCK_CLASS_ID = 58723
+# Warehouse ids locked by the blocks of each transaction:
+#   {transaction: [[warehouse id]]}
+_locked = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def warehouse_lock(warehouse_ids, timeout=None):
+    '''
+    Serialize the assignations of the warehouses with PostgreSQL transaction
+    advisory locks, so the shipments assigned are committed before another
+    process assigns the same warehouse.
+    It waits at most timeout seconds for each warehouse and yields the list
+    of locked warehouse ids. On other backends it yields all of them.
+    The locks are kept until the end of the transaction and they are taken
+    again after each commit of the block.
+    '''
+    warehouse_ids = sorted(set(warehouse_ids))
+    if backend.name() != 'postgresql':
+        yield warehouse_ids
+        return
+
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    locked = []
+    for warehouse_id in warehouse_ids:
+        with phase('lock_wait'):
+            if _acquire(cursor, warehouse_id, timeout):
+                locked.append(warehouse_id)
+    stack = _locked.setdefault(transaction, [])
+    stack.append(locked)
+    try:
+        yield locked
+    finally:
+        stack.remove(locked)
+
+
+def relock():
+    '''
+    Take again the warehouse locks of the blocks of the transaction released
+    by its commit. It waits for them as the other processes only keep them
+    until their commit.
+    '''
+    transaction = Transaction()
+    warehouse_ids = sorted(set(w for l in _locked.get(transaction, [])
+            for w in l))
+    if not warehouse_ids:
+        return
+    cursor = transaction.connection.cursor()
+    for warehouse_id in warehouse_ids:
+        with phase('lock_wait'):
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)',
+                (LOCK_CLASS_ID, warehouse_id))
+
+
+def _acquire(cursor, warehouse_id, timeout):
+    'Wait at most timeout seconds to lock the warehouse'
+    deadline = time() + (timeout or 0)
+    delay = 0.05
+    while True:
+        cursor.execute('SELECT pg_try_advisory_xact_lock(%s, %s)',
+            (LOCK_CLASS_ID, warehouse_id))
+        if cursor.fetchone()[0]:
+            return True
+        if time() >= deadline:
+            logger.info('Warehouse %s is locked by another assign process.',
+                warehouse_id)
+            return False
+        sleep(delay)
+        delay = min(delay * 2, 1)
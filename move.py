@@ -1,15 +1,37 @@
 # This file is part stock_lot_out_autoassign module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from collections import OrderedDict
+from collections import defaultdict
+import logging
+
+from trytond import backend
 from trytond.pool import Pool, PoolMeta
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
-from sql import Cast, Literal
-from sql.aggregate import Sum
-from sql.functions import Substring, Position
+from sql import Cast, Null, Window, With
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
+from sql.functions import Substring
 from sql.operators import Like
 
+from .assign import recorded, phase, count
+from .availability import allocate, allocate_partial
+from .lock import warehouse_lock
+from .tools import (savepoint, products_by_location, memoized,
+    forget_quantities)
+
 __all__ = ['Move']
+logger = logging.getLogger(__name__)
+
+# Shipment models joined with their moves
+SHIPMENT_MODELS = {
+    'stock.shipment.in': 'stock_move_shipment_in_id_index',
+    'stock.shipment.out': 'stock_move_shipment_out_id_index',
+    }
+
+# Fields of the moves changing the stock quantities
+QUANTITY_FIELDS = {'product', 'quantity', 'internal_quantity', 'uom',
+    'from_location', 'to_location', 'effective_date', 'lot'}
 
 
 class Move:
@@ -17,15 +39,165 @@ class Move:
     __name__ = 'stock.move'
     __metaclass__ = PoolMeta
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(Move, cls).__register__(module_name)
+
+        if backend.name() != 'postgresql':
+            return
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        # Partial indexes on the shipment id stored in the reference field so
+        # the joins of autoassign_out_moves do not scan all the moves
+        for model, index_name in SHIPMENT_MODELS.items():
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index_name,))
+            if cursor.fetchone():
+                continue
+            prefix = model + ','
+            cursor.execute('CREATE INDEX "%s" ON "%s" '
+                '((CAST(SUBSTRING("shipment" FROM %s) AS INTEGER))) '
+                'WHERE "shipment" LIKE \'%s%%\'' % (
+                    index_name, table._name, len(prefix) + 1, prefix))
+
+    @classmethod
+    def shipment_join_condition(cls, move, shipment, model):
+        '''
+        Returns the condition to join the move table with the shipment table
+        of model. The prefix filter and the extracted id match the partial
+        indexes created on register.
+        '''
+        prefix = model + ','
+        return (Like(move.shipment, prefix + '%')
+            & (Cast(Substring(move.shipment, len(prefix) + 1), 'INTEGER')
+                == shipment.id))
+
+    @classmethod
+    def get_reserved_quantities(cls, product_ids, location_ids=None,
+            subtrees=None):
+        '''
+        Returns the quantities, in product default UOM, reserved by the
+        assigned moves of any kind (customer and internal shipments, supplier
+        returns, productions...) computed in one aggregated query:
+            {(location id, product id): quantity}
+        The keys are the location_ids, which reserve the moves leaving them,
+        and the storage location of the subtrees, which reserve the moves
+        leaving the subtree.
+        '''
+        cursor = Transaction().connection.cursor()
+        move = cls.__table__()
+
+        location_ids = set(location_ids or [])
+        subtrees = subtrees or {}
+        from_ids = set(location_ids)
+        for subtree in subtrees.values():
+            from_ids.update(subtree.location_ids)
+        reserved = {}
+        if not from_ids or not product_ids:
+            return reserved
+
+        rows = []
+        for sub_location_ids in grouped_slice(from_ids):
+            for sub_product_ids in grouped_slice(product_ids):
+                query = move.select(
+                    move.from_location, move.to_location, move.product,
+                    Sum(move.internal_quantity),
+                    where=((move.state == 'assigned')
+                        & reduce_ids(move.from_location, sub_location_ids)
+                        & reduce_ids(move.product, sub_product_ids)),
+                    group_by=(move.from_location, move.to_location,
+                        move.product))
+                with phase('query'):
+                    cursor.execute(*query)
+                    rows.extend(cursor.fetchall())
+
+        subtree_ids = [(s.storage, set(s.location_ids))
+            for s in subtrees.values()]
+        for from_id, to_id, product_id, quantity in rows:
+            if from_id in location_ids:
+                key = (from_id, product_id)
+                reserved[key] = reserved.get(key, 0) + quantity
+            for storage_id, child_ids in subtree_ids:
+                # Moves inside the subtree do not change its quantity
+                if from_id in child_ids and to_id not in child_ids:
+                    key = (storage_id, product_id)
+                    reserved[key] = reserved.get(key, 0) + quantity
+        return reserved
+
+    @classmethod
+    def assign(cls, moves):
+        super(Move, cls).assign(moves)
+        if memoized():
+            forget_quantities(set(m.product.id for m in moves))
+
+    @classmethod
+    def cancel(cls, moves):
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        released = Blocked.get_stock_releases(moves)
+        super(Move, cls).cancel(moves)
+        if memoized():
+            forget_quantities(set(m.product.id for m in moves))
+        Blocked.unblock(released)
+
+    @classmethod
+    def draft(cls, moves):
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        released = Blocked.get_stock_releases(moves)
+        super(Move, cls).draft(moves)
+        if memoized():
+            forget_quantities(set(m.product.id for m in moves))
+        Blocked.unblock(released)
+
+    @classmethod
+    def write(cls, *args):
+        if not memoized():
+            super(Move, cls).write(*args)
+            return
+        # The quantities memoized of assigned or done moves change with them
+        product_ids = set()
+        actions = iter(args)
+        for moves, values in zip(actions, actions):
+            if not set(values) & QUANTITY_FIELDS:
+                continue
+            product_ids.update(m.product.id for m in moves
+                if m.state in ('assigned', 'done'))
+            if values.get('product'):
+                product_ids.add(values['product'])
+        super(Move, cls).write(*args)
+        if product_ids:
+            forget_quantities(product_ids)
+
     @classmethod
     def do(cls, moves):
-        ShipmentIn = Pool().get('stock.shipment.in')
+        pool = Pool()
+        ShipmentIn = pool.get('stock.shipment.in')
+        Pending = pool.get('stock.shipment.out.assign.pending')
+        Blocked = pool.get('stock.shipment.out.assign.blocked')
+        Configuration = pool.get('stock.configuration')
         super(Move, cls).do(moves)
+        if memoized():
+            forget_quantities(set(m.product.id for m in moves))
+
+        config = Configuration(1)
+        if config.autoassign_mode == 'deferred':
+            # Received moves are also assigned after commit by the pending
+            # scheduler, coalesced with other stock increases
+            Pending.add_moves(moves)
+            return
+
         in_moves = [m.id for m in moves if isinstance(m.shipment, ShipmentIn)]
         if in_moves:
+            Blocked.unblock(Pending.get_stock_increases(cls.browse(in_moves)))
             cls.autoassign_out_moves(in_moves)
+        # Other stock increases like inventories or returns are assigned by
+        # the pending scheduler
+        Pending.add_moves(
+            [m for m in moves if not isinstance(m.shipment, ShipmentIn)])
 
     @classmethod
+    @recorded('autoassign')
     def autoassign_out_moves(cls, move_ids):
         '''
         This method tries to auto assign output moves when input shipments pass
@@ -33,40 +205,87 @@ class Move:
         :param move_ids: List of ids moves of stock.shipment.in
         '''
         pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Pending = pool.get('stock.shipment.out.assign.pending')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        warehouse_ids = set(m.shipment.warehouse.id
+            for m in cls.browse(move_ids) if m.shipment)
+        # Do not make the user wait for another assign process, the received
+        # moves are queued instead
+        with warehouse_lock(warehouse_ids, 0) as locked:
+            if set(locked) != warehouse_ids:
+                # The shipments will be assigned by the pending scheduler
+                Pending.add_moves(cls.browse(move_ids))
+                return
+            # The single query does not know about lots nor partial assign
+            if (config.autoassign_single_query
+                    and config.partial_assign_policy != 'partial'
+                    and not ShipmentOut.get_ledger().lot_aware):
+                to_assign = cls.get_out_moves_to_assign_query(move_ids)
+                partial = []
+            else:
+                to_assign, partial = cls.get_out_moves_to_assign(move_ids)
+
+            if to_assign:
+                # As there could be shipments with more than one move, assign
+                # them by blocs of unique shipments, if one fails continue
+                # trying to assign the others
+                shipments = set(m.shipment for m in cls.browse(to_assign))
+                count('candidates', len(shipments))
+                ShipmentOut.assign_try_batch(list(shipments))
+            if partial:
+                # The moves are split to assign the quantity available and
+                # their shipments are kept waiting
+                try:
+                    with savepoint(), phase('assign_try'):
+                        cls.assign_try(cls.browse(partial))
+                except Exception:
+                    logger.warning('Moves %s can not be assigned.', partial,
+                        exc_info=True)
+
+    @classmethod
+    def get_out_moves_to_assign(cls, move_ids):
+        '''
+        Returns the ids of the draft output moves of the shipments that can be
+        served with the stock of the storage locations where move_ids were
+        received and, with the partial assign policy, the ids of the moves
+        of the other shipments that can be served, at least in part.
+        '''
+        pool = Pool()
         Location = pool.get('stock.location')
         ShipmentIn = pool.get('stock.shipment.in')
-        ShipmentOut = Pool().get('stock.shipment.out')
+        ShipmentOut = pool.get('stock.shipment.out')
         Date_ = Pool().get('ir.date')
-        Product = Pool().get('product.product')
+        Configuration = pool.get('stock.configuration')
+        Blocked = pool.get('stock.shipment.out.assign.blocked')
         cursor = Transaction().connection.cursor()
 
         move = cls.__table__()
         shipment_in = ShipmentIn.__table__()
         shipment_out = ShipmentOut.__table__()
+        blocked = Blocked.__table__()
+        config = Configuration(1)
         move_location = Location.__table__()
-        warehouse_location = Location.__table__()
-        storage_location = Location.__table__()
         today = Date_.today()
 
+        # Storage subtrees of the warehouses are cached to avoid joining the
+        # locations to their warehouse
+        subtrees = Location.get_storage_subtrees(set(
+                m.shipment.warehouse.id
+                for m in cls.browse(move_ids) if m.shipment))
+        if not subtrees:
+            return [], []
+
         # Get quantities of new products
         query = (move
-            .join(shipment_in, 'LEFT',
-                condition=(
-                    (Cast(Substring(move.shipment, Position(',', move.shipment)
-                        + Literal(1)), 'INTEGER') == shipment_in.id)
-                    &
-                    (Like(move.shipment, 'stock.shipment.in,%'))
-                ))
-            .join(warehouse_location, 'LEFT',
-                condition=(shipment_in.warehouse == warehouse_location.id))
-            .join(storage_location, 'LEFT', condition=(
-                    warehouse_location.storage_location == storage_location.id
-                    ))
-            .join(move_location, 'LEFT',
+            .join(shipment_in, condition=cls.shipment_join_condition(
+                    move, shipment_in, 'stock.shipment.in'))
+            .join(move_location,
                 condition=(move.to_location == move_location.id))
             .select(
-                # Gets root storage location no matter where product is stored
-                storage_location.id,
+                shipment_in.warehouse,
                 move.product,
                 Sum(move.quantity),
                 # to location of move could be child of storage location of
@@ -74,138 +293,309 @@ class Move:
                 where=(
                     (move.id.in_(move_ids))
                     &
-                    (move_location.right <= storage_location.right)
-                    &
-                    (move_location.left >= storage_location.left)
+                    Location.storage_subtree_condition(move_location,
+                        shipment_in.warehouse, subtrees)
                     ),
-                group_by=(storage_location.id, move.product),
+                group_by=(shipment_in.warehouse, move.product),
                 ))
-        cursor.execute(*query)
-        warehouse_inputs = {(wi[0], wi[1]): wi[2] for wi in cursor.fetchall()}
+        with phase('query'):
+            cursor.execute(*query)
+            rows = cursor.fetchall()
+        # Gets root storage location no matter where product is stored
+        warehouse_inputs = {(subtrees[wi[0]].storage, wi[1]): wi[2]
+            for wi in rows}
         if not warehouse_inputs:
-            return
+            return [], []
         storage_location_ids = [wi[0] for wi in warehouse_inputs]
         product_ids = [wi[1] for wi in warehouse_inputs]
+        subtrees = dict((w, s) for w, s in subtrees.items()
+            if s.storage in storage_location_ids)
 
         with Transaction().set_context(forecast=False,
                 stock_date_start=today,
-                stock_date_end=today):
+                stock_date_end=today), phase('products_by_location'):
             # Gets product by location quantities included output shipments in
             # assigned state
-            pbl = Product.products_by_location(storage_location_ids,
-                product_ids=product_ids, with_childs=True)
+            pbl = products_by_location(storage_location_ids, product_ids,
+                with_childs=True)
+
+        # Get quantities reserved by all the assigned moves in order to
+        # substract them of product by location quantities
+        reserved = cls.get_reserved_quantities(product_ids, subtrees=subtrees)
+
+        # Compute quantities of new products plus quantities stored
+        for warehouse_input in warehouse_inputs:
+            if (warehouse_input in pbl and
+                    pbl[warehouse_input] > warehouse_inputs[warehouse_input]):
+                warehouse_inputs[warehouse_input] = pbl[warehouse_input]
+                if warehouse_input in reserved:
+                    warehouse_inputs[warehouse_input] -= (
+                        reserved[warehouse_input])
+
+        # Expired lots can not serve the moves and moves with lot can only be
+        # served by their lot
+        lots = ShipmentOut.get_ledger()
+        if lots.lot_aware:
+            lots.extend(storage_location_ids, product_ids)
+            for warehouse_input in warehouse_inputs:
+                warehouse_inputs[warehouse_input] = min(
+                    warehouse_inputs[warehouse_input],
+                    lots.available(warehouse_input))
+            warehouse_inputs.update((k, q)
+                for k, q in lots.quantities.items() if len(k) == 3)
 
-        # Get quantities of assigned output moves in order to substract them of
-        # product by location quantities
+        # Get output shipments with draft moves of the products received
         query = (move
-            .join(shipment_out, 'LEFT',
-                condition=(
-                    (Cast(Substring(move.shipment,
-                                Position(',', move.shipment) + Literal(1)),
-                            'INTEGER') == shipment_out.id)
-                    &
-                    (Like(move.shipment, 'stock.shipment.out,%'))
-                ))
-            .join(warehouse_location, 'LEFT',
-                condition=shipment_out.warehouse == warehouse_location.id
-                )
-            .join(storage_location, 'LEFT', condition=(
-                    warehouse_location.storage_location == storage_location.id
+            .join(shipment_out, condition=cls.shipment_join_condition(
+                    move, shipment_out, 'stock.shipment.out'))
+            .join(move_location, condition=(
+                    (move.from_location == move_location.id)
                     ))
-            .join(move_location, 'LEFT',
-                condition=(move.from_location == move_location.id))
             .select(
-                storage_location.id,
-                move.product,
-                Sum(move.quantity),
+                shipment_out.id,
+                shipment_out.warehouse,
                 # from location of move could be child of storage location of
                 # shipment warehouse
                 where=(
-                    (shipment_out.state == 'assigned')
-                    &
-                    (move_location.right <= storage_location.right)
+                    (move.state == 'draft')
                     &
-                    (move_location.left >= storage_location.left)
+                    Location.storage_subtree_condition(move_location,
+                        shipment_out.warehouse, subtrees)
                     &
                     (move.product.in_(product_ids))
                     &
-                    (storage_location.id.in_(storage_location_ids))
+                    # blocked by other products
+                    ~shipment_out.id.in_(blocked.select(blocked.shipment))
                     ),
-                group_by=(storage_location.id, move.product),
+                group_by=(shipment_out.id, shipment_out.warehouse),
                 ))
-        cursor.execute(*query)
-        assigned_out_moves = {(om[0], om[1]): om[2]
-            for om in cursor.fetchall()}
+        with phase('query'):
+            cursor.execute(*query)
+            shipment_warehouses = dict(cursor.fetchall())
 
-        # Compute quantities of new products plus quantities stored
-        for warehouse_input in warehouse_inputs:
-            if (warehouse_input in pbl and
-                    pbl[warehouse_input] > warehouse_inputs[warehouse_input]):
-                warehouse_inputs[warehouse_input] = pbl[warehouse_input]
-                if warehouse_input in assigned_out_moves:
-                    warehouse_inputs[warehouse_input] -= (
-                        assigned_out_moves[warehouse_input])
+        # Shipments are evaluated once with all their draft moves
+        requirements = {}
+        shipment_moves = defaultdict(list)
+        other_product_ids = set()
+        for row in ShipmentOut.get_inventory_move_rows(
+                list(shipment_warehouses)):
+            shipment_id, move_id, state, location_id, product_id, _, \
+                quantity, lot_id = row
+            subtree = subtrees[shipment_warehouses[shipment_id]]
+            if (state != 'draft'
+                    or location_id not in subtree.location_ids):
+                continue
+            keys = [(subtree.storage, product_id)]
+            if lots.lot_aware and lot_id:
+                keys.append((subtree.storage, product_id, lot_id))
+            needs = requirements.setdefault(shipment_id, {})
+            for key in keys:
+                needs[key] = needs.get(key, 0) + quantity
+            shipment_moves[shipment_id].append(
+                (move_id, dict((k, quantity) for k in keys)))
+            if product_id not in product_ids:
+                other_product_ids.add(product_id)
 
-        # Get output moves in draft states ordered by shipment planned date
-        query = (move
-            .join(shipment_out, 'LEFT',
-                condition=(
-                    (Cast(Substring(move.shipment,
-                                Position(',', move.shipment) + Literal(1)),
-                            'INTEGER') == shipment_out.id)
-                    &
-                    (Like(move.shipment, 'stock.shipment.out,%'))
-                ))
-            .join(warehouse_location, 'LEFT',
-                condition=shipment_out.warehouse == warehouse_location.id
-                )
-            .join(storage_location, 'LEFT', condition=(
+        # The stock of the other products of the shipments is loaded
+        ledger = ShipmentOut.get_ledger(quantities=warehouse_inputs)
+        ledger.extend(storage_location_ids, other_product_ids)
+
+        # Checks if there is enough quantity to serve the shipments in the
+        # order of the allocation strategy
+        candidates = ShipmentOut.get_assign_candidates(
+            ShipmentOut.browse(list(requirements)), requirements)
+        strategy = ShipmentOut.get_allocation_strategy()
+        if config.partial_assign_policy == 'partial':
+            allocated, partial = allocate_partial(candidates, shipment_moves,
+                ledger, strategy)
+        else:
+            allocated, partial = allocate(candidates, ledger, strategy), []
+        to_assign = [m for c in allocated for m, _ in shipment_moves[c.id]]
+        return to_assign, partial
+
+    @classmethod
+    def get_out_moves_to_assign_query(cls, move_ids):
+        '''
+        Same as get_out_moves_to_assign but computed in a single query: the
+        stock of the storage locations is computed from the moves and a draft
+        output move fits when the running demand of its (storage location,
+        product), ordered by shipment planned date, does not exceed it.
+        Only the moves of the shipments whose draft moves all fit are
+        returned. Unlike the Python fit, a move that does not fit still
+        consumes the running demand of the following moves of the same
+        product and the allocation strategy is always first planned first
+        served.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        ShipmentIn = pool.get('stock.shipment.in')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Date_ = pool.get('ir.date')
+        Blocked = pool.get('stock.shipment.out.assign.blocked')
+        cursor = Transaction().connection.cursor()
+
+        move = cls.__table__()
+        shipment_in = ShipmentIn.__table__()
+        shipment_out = ShipmentOut.__table__()
+        blocked = Blocked.__table__()
+        move_location = Location.__table__()
+        from_location = Location.__table__()
+        to_location = Location.__table__()
+        warehouse_location = Location.__table__()
+        storage_location = Location.__table__()
+        today = Date_.today()
+
+        # Storage locations and products received
+        inputs = With('storage', 'left', 'right', 'product', query=move
+            .join(shipment_in, condition=cls.shipment_join_condition(
+                    move, shipment_in, 'stock.shipment.in'))
+            .join(warehouse_location,
+                condition=(shipment_in.warehouse == warehouse_location.id))
+            .join(storage_location, condition=(
                     warehouse_location.storage_location == storage_location.id
                     ))
-            .join(move_location, 'LEFT', condition=(
-                    (move.from_location == move_location.id)
-                    ))
+            .join(move_location,
+                condition=(move.to_location == move_location.id))
             .select(
-                move.id,
                 storage_location.id,
+                storage_location.left,
+                storage_location.right,
                 move.product,
-                move.quantity,
-                # from location of move could be child of storage location of
-                # shipment warehouse
                 where=(
-                    (move.state == 'draft')
+                    (move.id.in_(move_ids))
                     &
                     (move_location.right <= storage_location.right)
                     &
                     (move_location.left >= storage_location.left)
+                    ),
+                group_by=(storage_location.id, storage_location.left,
+                    storage_location.right, move.product),
+                ))
+
+        def inside(location, tree):
+            return ((location.left >= tree.left)
+                & (location.right <= tree.right))
+
+        # Not blocked output shipments with draft moves of the products
+        # received
+        candidates = With('shipment', 'storage', 'left', 'right', query=move
+            .join(shipment_out, condition=cls.shipment_join_condition(
+                    move, shipment_out, 'stock.shipment.out'))
+            .join(warehouse_location,
+                condition=shipment_out.warehouse == warehouse_location.id)
+            .join(inputs, condition=(
+                    (warehouse_location.storage_location == inputs.storage)
+                    & (move.product == inputs.product)))
+            .join(move_location,
+                condition=move.from_location == move_location.id)
+            .select(
+                shipment_out.id,
+                inputs.storage,
+                inputs.left,
+                inputs.right,
+                where=(
+                    (move.state == 'draft')
                     &
-                    (move.product.in_(product_ids))
+                    inside(move_location, inputs)
                     &
-                    (storage_location.id.in_(storage_location_ids))
+                    ~shipment_out.id.in_(blocked.select(blocked.shipment))
                     ),
-                order_by=shipment_out.planned_date.asc,
+                group_by=(shipment_out.id, inputs.storage, inputs.left,
+                    inputs.right),
                 ))
-        cursor.execute(*query)
-        moves = OrderedDict()
-        for move in cursor.fetchall():
-            if move[0] in moves:
-                moves[move[0]].update({(move[1], move[2]): move[3]})
-            else:
-                moves[move[0]] = {(move[1], move[2]): move[3]}
-
-        # Checks if there is enough quantity to serve the move
-        to_assign = []
-        for move in moves:
-            for out_product in moves[move]:
-                if (out_product in warehouse_inputs and
-                        moves[move][out_product] <=
-                        warehouse_inputs[out_product]):
-                    to_assign.append(move)
-                    warehouse_inputs[out_product] -= moves[move][out_product]
-
-        if to_assign:
-            # As there could be shipments with more than one move, it must try
-            # assign shipments one by one because of, if one fails, continue
-            # trying to assign the others
-            for move in cls.browse(to_assign):
-                ShipmentOut.assign_try([move.shipment])
+
+        # Storage locations and products of all the draft moves of the
+        # candidates
+        needed = With('storage', 'left', 'right', 'product', query=move
+            .join(shipment_out, condition=cls.shipment_join_condition(
+                    move, shipment_out, 'stock.shipment.out'))
+            .join(candidates, condition=shipment_out.id == candidates.shipment)
+            .join(move_location,
+                condition=move.from_location == move_location.id)
+            .select(
+                candidates.storage,
+                candidates.left,
+                candidates.right,
+                move.product,
+                where=(
+                    (move.state == 'draft')
+                    &
+                    inside(move_location, candidates)
+                    ),
+                group_by=(candidates.storage, candidates.left,
+                    candidates.right, move.product),
+                ))
+
+        # Stock of the storage locations: done moves in and done or assigned
+        # moves out
+        incoming = (inside(to_location, needed)
+            & ~inside(from_location, needed)
+            & (move.state == 'done')
+            & ((move.effective_date == Null) | (move.effective_date <= today)))
+        outgoing = (inside(from_location, needed)
+            & ~inside(to_location, needed)
+            & (((move.state == 'done')
+                    & ((move.effective_date == Null)
+                        | (move.effective_date <= today)))
+                | (move.state == 'assigned')))
+        stock = With('storage', 'product', 'quantity', query=move
+            .join(needed, condition=move.product == needed.product)
+            .join(from_location,
+                condition=move.from_location == from_location.id)
+            .join(to_location, condition=move.to_location == to_location.id)
+            .select(
+                needed.storage,
+                needed.product,
+                Sum(Case((incoming, move.internal_quantity), else_=0)
+                    - Case((outgoing, move.internal_quantity), else_=0)),
+                where=incoming | outgoing,
+                group_by=(needed.storage, needed.product),
+                ))
+
+        # Running demand of the draft moves of the candidates by planned date
+        # with the number of draft moves of their shipment
+        demand = With('move', 'shipment', 'storage', 'product', 'cumulative',
+            'moves', query=move
+            .join(shipment_out, condition=cls.shipment_join_condition(
+                    move, shipment_out, 'stock.shipment.out'))
+            .join(candidates, condition=shipment_out.id == candidates.shipment)
+            .join(move_location,
+                condition=move.from_location == move_location.id)
+            .select(
+                move.id,
+                shipment_out.id,
+                candidates.storage,
+                move.product,
+                Sum(move.internal_quantity, window=Window(
+                        [candidates.storage, move.product],
+                        order_by=[shipment_out.planned_date.asc,
+                            move.id.asc])),
+                Count(move.id, window=Window([shipment_out.id])),
+                where=(
+                    (move.state == 'draft')
+                    &
+                    inside(move_location, candidates)
+                    ),
+                ))
+
+        # Moves that fit with the number of moves that fit of their shipment,
+        # the window is computed after the where clause
+        fits = With('move', 'moves', 'fitting', query=demand
+            .join(stock, condition=(
+                    (demand.storage == stock.storage)
+                    & (demand.product == stock.product)))
+            .select(
+                demand.move,
+                demand.moves,
+                Count(demand.move, window=Window([demand.shipment])),
+                where=demand.cumulative <= stock.quantity,
+                ))
+
+        # Only the moves of the shipments that fit as a whole
+        query = fits.select(
+            fits.move,
+            where=fits.fitting == fits.moves,
+            with_=[inputs, candidates, needed, stock, demand, fits])
+        with phase('query'):
+            cursor.execute(*query)
+            return [m for m, in cursor.fetchall()]
@@ -0,0 +1,18 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+
+__all__ = ['Party']
+
+
+class Party:
+    __name__ = 'party.party'
+    __metaclass__ = PoolMeta
+    assign_priority = fields.Integer('Assign Priority',
+        help=("Shipments of parties with higher priority are assigned first "
+            "when the allocation strategy is by party priority."))
+
+    @staticmethod
+    def default_assign_priority():
+        return 0
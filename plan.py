@@ -0,0 +1,129 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval
+from trytond.tools import reduce_ids, grouped_slice
+from trytond.transaction import Transaction
+
+from .assign import recorded, count
+from .lock import warehouse_lock
+
+__all__ = ['ShipmentOutAssignPlan', 'ShipmentOutAssignPlanLine']
+
+
+class ShipmentOutAssignPlan(ModelSQL, ModelView):
+    'Shipment Out Assign Plan'
+    __name__ = 'stock.shipment.out.assign.plan'
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        readonly=True, domain=[('type', '=', 'warehouse')])
+    from_datetime = fields.DateTime('From Date & Time', readonly=True)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('applied', 'Applied'),
+            ], 'State', required=True, readonly=True)
+    stock_version = fields.Char('Stock Version', readonly=True,
+        help="Version of the stock of the plan locations and products when "
+        "it was computed.")
+    lines = fields.One2Many('stock.shipment.out.assign.plan.line', 'plan',
+        'Lines', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentOutAssignPlan, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'apply': {
+                    'invisible': Eval('state') != 'draft',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @classmethod
+    def create(cls, vlist):
+        plans = super(ShipmentOutAssignPlan, cls).create(vlist)
+        for plan in plans:
+            plan.stock_version = plan.get_stock_version()
+        cls.save(plans)
+        return plans
+
+    def get_stock_version(self):
+        '''
+        Returns the version of the stock of the locations and products of the
+        lines: any move created, modified or deleted changes it.
+        '''
+        Move = Pool().get('stock.move')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+
+        location_ids = list(set(l.location.id for l in self.lines))
+        product_ids = list(set(l.product.id for l in self.lines))
+        if not location_ids:
+            return ''
+        number, last = 0, None
+        for sub_product_ids in grouped_slice(product_ids):
+            cursor.execute(*move.select(
+                    Count(move.id),
+                    Max(Coalesce(move.write_date, move.create_date)),
+                    where=(reduce_ids(move.product, sub_product_ids)
+                        & (reduce_ids(move.from_location, location_ids)
+                            | reduce_ids(move.to_location, location_ids)))))
+            sub_number, sub_last = cursor.fetchone()
+            number += sub_number
+            if sub_last and (last is None or sub_last > last):
+                last = sub_last
+        return '%s@%s' % (number, last)
+
+    @classmethod
+    @ModelView.button
+    @recorded('plan')
+    def apply(cls, plans):
+        '''
+        Assign the shipments of the plans. If the stock has changed since the
+        plan was computed, the shipments are checked again first.
+        '''
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        with warehouse_lock(set(p.warehouse.id for p in plans),
+                config.assign_lock_timeout) as locked:
+            for plan in plans:
+                if plan.warehouse.id not in locked:
+                    ShipmentOut.raise_user_error('warehouse_locked',
+                        (plan.warehouse.rec_name,))
+            for plan in plans:
+                shipments = list(set(l.shipment for l in plan.lines
+                        if l.shipment.state == 'waiting'))
+                if plan.stock_version != plan.get_stock_version():
+                    shipments = ShipmentOut.get_satisfiable(shipments)
+                else:
+                    count('candidates', len(shipments))
+                ShipmentOut.assign_try_batch(shipments)
+            cls.write(plans, {'state': 'applied'})
+
+
+class ShipmentOutAssignPlanLine(ModelSQL, ModelView):
+    'Shipment Out Assign Plan Line'
+    __name__ = 'stock.shipment.out.assign.plan.line'
+    plan = fields.Many2One('stock.shipment.out.assign.plan', 'Plan',
+        required=True, select=True, ondelete='CASCADE')
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, readonly=True, ondelete='CASCADE')
+    move = fields.Many2One('stock.move', 'Move', required=True, readonly=True,
+        ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        readonly=True)
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True)
+    quantity = fields.Float('Quantity', readonly=True,
+        help="Quantity taken by the move.")
+    remaining = fields.Float('Remaining', readonly=True,
+        help="Quantity available in the location after the move.")
@@ -1,30 +1,52 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from sql import Table
-from time import sleep
+from sql import Literal
+from sql.conditionals import Coalesce
 from trytond.model import fields, ModelView
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, Id, PYSONEncoder
 from trytond.transaction import Transaction
-from trytond.wizard import Wizard, StateView, Button, StateAction
+from trytond.wizard import (Wizard, StateView, StateTransition, Button,
+    StateAction)
 from trytond.tools import reduce_ids, grouped_slice
+from collections import defaultdict
 import datetime
 import logging
+import threading
+import time
+
+from .assign import recorded, phase, count
+from .availability import Candidate, Ledger, STRATEGIES, allocate
+from .lock import warehouse_lock
+from .tools import (savepoint, search_pages_after, keyset_after, commit,
+    rollback)
 
 __all__ = ['ShipmentOut', 'ShipmentOutAssignWizardStart',
     'ShipmentOutAssignWizard']
 logger = logging.getLogger(__name__)
 
 
+class NotAssigned(Exception):
+    'Raised to roll back a bloc of shipments not fully assigned'
+
+
 class ShipmentOut:
     __metaclass__ = PoolMeta
     __name__ = 'stock.shipment.out'
     __metaclass__ = PoolMeta
+    assign_blocked = fields.Function(fields.Boolean('Assign Blocked',
+            help="The last try to assign the shipment failed and the stock of "
+            "its products has not increased since then."),
+        'get_assign_blocked', searcher='search_assign_blocked')
 
     @classmethod
     def __setup__(cls):
         super(ShipmentOut, cls).__setup__()
 
+        cls._error_messages.update({
+                'warehouse_locked': ('The shipments of warehouse "%s" are '
+                    'being assigned by another process. Try again later.'),
+                })
         cls._buttons.update({
                 'try_assign': {
                     'invisible': Eval('state') != 'waiting',
@@ -34,75 +56,415 @@ class ShipmentOut:
                 })
 
     @classmethod
-    def stock_move_locked(cls):
-        transaction = Transaction()
-        cursor = transaction.connection.cursor()
-
-        pg_activity = Table('pg_stat_activity')
-        pg_locks = Table('pg_locks')
-        pg_class = Table('pg_class')
-
-        cursor.execute(*pg_activity
-            .join(pg_locks, 'LEFT',
-                condition=(pg_activity.pid == pg_locks.pid))
-            .join(pg_class, 'LEFT',
-                condition=(pg_locks.relation == pg_class.oid))
-            .select(
-                pg_activity.pid,
-                where=(
-                    (pg_locks.mode == 'ExclusiveLock')
-                    &
-                    (pg_class.relname == 'stock_move')
-                    ),
-                )
-            )
-        return cursor.fetchall()
-
-    @classmethod
-    def get_assignable(cls, shipments):
+    def get_assign_blocked(cls, shipments, name):
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+        cursor = Transaction().connection.cursor()
+        blocked = Blocked.__table__()
+
+        result = dict((s.id, False) for s in shipments)
+        for sub_ids in grouped_slice(list(result)):
+            cursor.execute(*blocked.select(blocked.shipment,
+                    where=reduce_ids(blocked.shipment, sub_ids),
+                    group_by=blocked.shipment))
+            result.update((shipment_id, True) for shipment_id, in cursor)
+        return result
+
+    @classmethod
+    def search_assign_blocked(cls, name, clause):
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+        blocked = Blocked.__table__()
+
+        _, operator, value = clause
+        query = blocked.select(blocked.shipment)
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
+
+    @classmethod
+    def write(cls, *args):
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        super(ShipmentOut, cls).write(*args)
+        # Modified shipments are tried again
+        actions = iter(args)
+        Blocked.unblock_shipments([s.id
+                for shipments, _ in zip(actions, actions) for s in shipments])
+
+    @classmethod
+    def assign_try_bisect(cls, shipments):
+        '''
+        Try to assign the shipments in one call inside a savepoint. If it
+        fails or they are not all assigned, it is rolled back and each half
+        is tried again, isolating the failing shipments in O(log n) tries.
+        Returns the lists of assigned and not assigned shipments.
+        The shipments not assigned for lack of stock are blocked by all their
+        products. As the stock counted for the shipments not assigned is
+        free, the shipments blocked by their products are unblocked.
+        '''
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        if not shipments:
+            return [], []
+        if len(shipments) == 1:
+            shipment, = shipments
+            error = False
+            try:
+                with savepoint(), phase('assign_try'):
+                    if cls.assign_try(shipments):
+                        count('assigned')
+                        return shipments, []
+            except Exception:
+                logger.warning('Shipment %s can not be assigned.',
+                    shipment.id, exc_info=True)
+                error = True
+            # The stock allocated to the shipment may have blocked others
+            Blocked.unblock(set((shipment.warehouse.id, m.product.id)
+                    for m in shipment.inventory_moves))
+            # Errors may be transient so the shipment is not blocked
+            if not error:
+                Blocked.block(cls.get_assign_requirements(shipments))
+            return [], shipments
+
+        try:
+            with savepoint(), phase('assign_try'):
+                if not cls.assign_try(shipments):
+                    # Roll back the moves assigned of the bloc
+                    raise NotAssigned
+            count('assigned', len(shipments))
+            return shipments, []
+        except NotAssigned:
+            pass
+        except Exception:
+            logger.info('Bloc of shipments %s can not be assigned.',
+                [s.id for s in shipments], exc_info=True)
+        shipments = cls.browse([s.id for s in shipments])
+        half = len(shipments) // 2
+        assigned, failed = cls.assign_try_bisect(shipments[:half])
+        other_assigned, other_failed = cls.assign_try_bisect(shipments[half:])
+        return assigned + other_assigned, failed + other_failed
+
+    @classmethod
+    def get_inventory_move_rows(cls, shipment_ids):
+        '''
+        Returns the inventory moves of the shipments read in bulk as tuples:
+            (shipment id, move id, state, from location id, product id,
+                quantity, internal quantity, lot id)
+        The lot id is None if the moves have no lot.
+        '''
         pool = Pool()
-        Product = pool.get('product.product')
-        Date = pool.get('ir.date')
+        Move = pool.get('stock.move')
         Location = pool.get('stock.location')
+        cursor = Transaction().connection.cursor()
+
+        move = Move.__table__()
+        shipment = cls.__table__()
+        warehouse = Location.__table__()
+
+        query = (move
+            .join(shipment, condition=Move.shipment_join_condition(
+                    move, shipment, cls.__name__))
+            .join(warehouse, condition=shipment.warehouse == warehouse.id))
+        lot = move.lot if 'lot' in Move._fields else Literal(None)
+        rows = []
+        for sub_ids in grouped_slice(shipment_ids):
+            with phase('query'):
+                cursor.execute(*query.select(
+                        shipment.id, move.id, move.state, move.from_location,
+                        move.product, move.quantity, move.internal_quantity,
+                        lot,
+                        where=(reduce_ids(shipment.id, sub_ids)
+                            & (move.to_location == warehouse.output_location)),
+                        order_by=move.id.asc))
+                rows.extend(cursor.fetchall())
+        return rows
 
-        today = Date.today()
-        product_ids = set()
-        locations = set()
-        for shipment in shipments:
-            for move in shipment.inventory_moves:
-                product_ids.add(move.product.id)
-                locations.add(move.from_location)
-
-        location_ids = [l.id for l in Location.search([
-                    ('parent', 'child_of', list(locations))
-                    ])]
+    @classmethod
+    @recorded('wizard')
+    def get_assignable(cls, shipments, ledger=None, plan=None):
+        '''
+        Returns the shipments whose moves can be served with the stock of the
+        ledger. A ledger can be given to carry the stock between calls.
+        If a plan list is given, the values of the plan lines (shipment, move,
+        location, product, quantity taken and remaining) are appended to it.
+        '''
+        Location = Pool().get('stock.location')
 
-        with Transaction().set_context(forecast=False, stock_date_end=today):
-            pbl = Product.products_by_location(
-                    list(location_ids), list(product_ids), with_childs=False)
+        if ledger is None:
+            ledger = cls.get_ledger(with_childs=False, stock_assign=False,
+                deduct_reserved=True)
+        shipment_moves = defaultdict(list)
+        product_ids = set()
+        location_ids = set()
+        for row in cls.get_inventory_move_rows([s.id for s in shipments]):
+            shipment_id, move_id, _, location_id, product_id, quantity, _, \
+                lot_id = row
+            keys = [(location_id, product_id)]
+            if ledger.lot_aware and lot_id:
+                keys.append((location_id, product_id, lot_id))
+            shipment_moves[shipment_id].append((keys, quantity, move_id))
+            product_ids.add(product_id)
+            location_ids.add(location_id)
+
+        # Storage subtrees are cached and from locations outside of them are
+        # kept as their quantity is read without childs
+        for subtree in Location.get_storage_subtrees(
+                set(s.warehouse.id for s in shipments)).values():
+            location_ids.update(subtree.location_ids)
+
+        ledger.extend(location_ids, product_ids)
         assignable_shipments = []
+        count('candidates', len(shipments))
 
+        # Try the shipments in the order of the allocation strategy
+        requirements = {}
         for shipment in shipments:
-            for move in shipment.inventory_moves:
-                if ((move.from_location.id, move.product.id) not in pbl
-                        or move.quantity >= pbl[
-                            (move.from_location.id, move.product.id)]):
-                    break
-            else:
-                for m in shipment.inventory_moves:
-                    pbl[(m.from_location.id, m.product.id)] -= m.quantity
-                assignable_shipments.append(shipment)
+            needs = requirements.setdefault(shipment.id, {})
+            for keys, quantity, _ in shipment_moves[shipment.id]:
+                for key in keys:
+                    needs[key] = needs.get(key, 0) + quantity
+        by_id = dict((s.id, s) for s in shipments)
+        strategy = cls.get_allocation_strategy()
+        shipments = [by_id[c.id] for c in strategy(
+                cls.get_assign_candidates(shipments, requirements),
+                ledger)]
+
+        with phase('fit'):
+            for shipment in shipments:
+                moves = shipment_moves[shipment.id]
+                for keys, quantity, _ in moves:
+                    if any(quantity >= ledger.available(k) for k in keys):
+                        break
+                else:
+                    for keys, quantity, move_id in moves:
+                        for key in keys:
+                            ledger.quantities[key] = (
+                                ledger.available(key) - quantity)
+                        if plan is not None:
+                            location_id, product_id = keys[0]
+                            plan.append({
+                                    'shipment': shipment.id,
+                                    'move': move_id,
+                                    'location': location_id,
+                                    'product': product_id,
+                                    'quantity': quantity,
+                                    'remaining': ledger.available(keys[0]),
+                                    })
+                    assignable_shipments.append(shipment)
+        count('assigned', len(assignable_shipments))
         return assignable_shipments
 
+    @classmethod
+    def assign_try_batch(cls, shipments, slice_try_assign=None):
+        '''
+        Try to assign shipments in planned date order by blocs.
+        Shipments are deduplicated and each bloc is bisected if it can not be
+        fully assigned, so a failing shipment does not prevent the others to
+        be assigned.
+        Returns the list of assigned shipments.
+        '''
+        Configuration = Pool().get('stock.configuration')
+
+        if slice_try_assign is None:
+            slice_try_assign = Configuration(1).slice_try_assign
+        shipment_ids = list(set(s.id for s in shipments))
+        shipments = sorted(
+            [s for s in cls.browse(shipment_ids) if s.state == 'waiting'],
+            key=lambda s: (s.planned_date or datetime.date.max, s.id))
+        slice_try_assign = slice_try_assign or len(shipments)
+
+        assigned = []
+        for sub_shipments in grouped_slice(shipments, slice_try_assign):
+            assigned.extend(cls.assign_try_bisect(list(sub_shipments))[0])
+        return assigned
+
+    @classmethod
+    def get_assign_requirements(cls, shipments, lot_aware=False):
+        '''
+        Returns a dict with the quantities, in product default UOM, needed by
+        the moves to assign of each shipment:
+            {shipment id: {(location id, product id): quantity}}
+        If lot_aware, the moves with lot also need the quantity of
+        (location id, product id, lot id).
+        '''
+        requirements = dict((s.id, {}) for s in shipments)
+        for row in cls.get_inventory_move_rows(list(requirements)):
+            shipment_id, _, state, location_id, product_id, _, quantity, \
+                lot_id = row
+            if state != 'draft':
+                continue
+            needs = requirements[shipment_id]
+            keys = [(location_id, product_id)]
+            if lot_aware and lot_id:
+                keys.append((location_id, product_id, lot_id))
+            for key in keys:
+                needs[key] = needs.get(key, 0) + quantity
+        return requirements
+
+    @classmethod
+    def get_ledger(cls, **kwargs):
+        '''
+        Returns an empty ledger, lot aware if it is set in the configuration
+        and the moves have lots.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Date = pool.get('ir.date')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        if config.assign_lot_aware and 'lot' in Move._fields:
+            kwargs.setdefault('lot_aware', True)
+            kwargs.setdefault('expiry_date', Date.today()
+                + datetime.timedelta(days=config.lot_expiry_margin or 0))
+        return Ledger(**kwargs)
+
+    @classmethod
+    def get_allocation_strategies(cls):
+        '''
+        Returns the allocation strategies by name. A strategy is a function
+        that sorts a list of candidates given the ledger of the stock.
+        '''
+        return STRATEGIES.copy()
+
+    @classmethod
+    def get_allocation_strategy(cls):
+        Configuration = Pool().get('stock.configuration')
+
+        config = Configuration(1)
+        return cls.get_allocation_strategies()[
+            config.allocation_strategy or 'fifo']
+
+    @classmethod
+    def get_assign_candidates(cls, shipments, requirements):
+        '''
+        Returns the candidates of the shipments to allocate the stock with
+        their planned date and the assign priority of their customer.
+        requirements: {shipment id: {(location id, product id): quantity}}
+        '''
+        Party = Pool().get('party.party')
+        cursor = Transaction().connection.cursor()
+
+        shipment = cls.__table__()
+        party = Party.__table__()
+
+        query = shipment.join(party,
+            condition=shipment.customer == party.id)
+        candidates = {}
+        for sub_ids in grouped_slice([s.id for s in shipments]):
+            cursor.execute(*query.select(
+                    shipment.id, shipment.planned_date, party.assign_priority,
+                    where=reduce_ids(shipment.id, sub_ids)))
+            for shipment_id, planned_date, priority in cursor.fetchall():
+                candidates[shipment_id] = Candidate(shipment_id, planned_date,
+                    priority, requirements.get(shipment_id, {}))
+        return [candidates[s.id] for s in shipments]
+
+    @classmethod
+    def search_allocation_pages(cls, domain, page_size):
+        '''
+        Yield the shipments matching domain by pages of page_size in the
+        order of the allocation strategy: by the priority of the customer with
+        party priority and then by planned date. The pages are read with
+        keyset pagination so only one page is in memory and its shipments can
+        be modified, or committed, before reading the next one.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Configuration = pool.get('stock.configuration')
+        cursor = Transaction().connection.cursor()
+
+        shipment = cls.__table__()
+        party = Party.__table__()
+
+        # Same keys as the strategies without the stock, which is taken into
+        # account inside each page
+        keys = [Coalesce(shipment.planned_date, datetime.date.max),
+            shipment.id]
+        if Configuration(1).allocation_strategy == 'party_priority':
+            keys.insert(0, -Coalesce(party.assign_priority, 0))
+        query = shipment.join(party, condition=shipment.customer == party.id)
+        after = None
+        while True:
+            where = shipment.id.in_(cls.search(domain, order=[], query=True))
+            if after:
+                where &= keyset_after(keys, after)
+            cursor.execute(*query.select(*keys, where=where,
+                    order_by=[k.asc for k in keys], limit=page_size or None))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield cls.browse([r[-1] for r in rows])
+            if not page_size or len(rows) < page_size:
+                break
+            after = rows[-1]
+
+    @classmethod
+    def get_satisfiable(cls, shipments, ledger=None):
+        '''
+        Returns the shipments that could be assigned with the stock of the
+        ledger, which is decremented with the quantities of these shipments.
+        If no ledger is given, it is loaded once for all the shipments,
+        otherwise it is extended with their locations and products.
+        The other shipments are blocked by the pairs they lack.
+        '''
+        Blocked = Pool().get('stock.shipment.out.assign.blocked')
+
+        count('candidates', len(shipments))
+        if ledger is None:
+            ledger = cls.get_ledger()
+        requirements = cls.get_assign_requirements(shipments,
+            lot_aware=ledger.lot_aware)
+        location_ids, product_ids = set(), set()
+        for needs in requirements.values():
+            for key in needs:
+                location_ids.add(key[0])
+                product_ids.add(key[1])
+        ledger.extend(location_ids, product_ids)
+
+        by_id = dict((s.id, s) for s in shipments)
+        candidates = cls.get_assign_candidates(shipments, requirements)
+        satisfiable = [by_id[c.id] for c in allocate(candidates, ledger,
+                cls.get_allocation_strategy())]
+        # Block the others by the products they lack
+        satisfiable_ids = set(s.id for s in satisfiable)
+        Blocked.block(dict((k, v) for k, v in requirements.items()
+                if k not in satisfiable_ids), ledger)
+        return satisfiable
+
     @classmethod
     @ModelView.button
+    @recorded('try_assign')
     def try_assign(cls, shipments):
-        for s in shipments:
-            if s.state != 'waiting':
-                continue
-            cls.assign_try([s])
+        pool = Pool()
+        Job = pool.get('stock.shipment.out.assign.job')
+        ModelData = pool.get('ir.model.data')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        shipments = [s for s in shipments if s.state == 'waiting']
+        if (config.try_assign_background
+                and len(shipments) >= config.try_assign_background):
+            # Return to the user before the client times out with the jobs
+            # to follow the progress
+            Job.submit(shipments)
+            return ModelData.get_id('stock_shipment_out_autoassign',
+                'act_shipment_out_assign_job')
+        with warehouse_lock(set(s.warehouse.id for s in shipments),
+                config.assign_lock_timeout) as locked:
+            for shipment in shipments:
+                if shipment.warehouse.id not in locked:
+                    cls.raise_user_error('warehouse_locked',
+                        (shipment.warehouse.rec_name,))
+            count('candidates', len(shipments))
+            for s in shipments:
+                if s.state != 'waiting':
+                    continue
+                with phase('assign_try'):
+                    if cls.assign_try([s]):
+                        count('assigned')
 
     @classmethod
+    @recorded('wait')
     def wait(cls, shipments):
         Configuration = Pool().get('stock.configuration')
 
@@ -113,58 +475,197 @@ class ShipmentOut:
 
         if config.try_wait2assign and shipments_ids \
                 and Transaction().context.get('assign_try', True):
-            with Transaction().set_context(_check_access=False):
-                shipments_to_assign = cls.browse(shipments_ids)
-                for s in shipments_to_assign:
-                    cls.assign_try([s])
-                    Transaction().commit()
+            shipments = cls.browse(shipments_ids)
+            with Transaction().set_context(_check_access=False), \
+                    warehouse_lock(set(s.warehouse.id for s in shipments),
+                        config.assign_lock_timeout) as locked:
+                # The shipments of the warehouses assigned by another process
+                # are left to the scheduler
+                shipments = [s for s in shipments
+                    if s.warehouse.id in locked]
+                if shipments:
+                    # Compute the stock once for all the shipments and try
+                    # the satisfiable ones by blocs isolated in savepoints
+                    shipments_to_assign = cls.get_satisfiable(shipments)
+                    cls.assign_try_batch(shipments_to_assign)
 
     @classmethod
+    @recorded('scheduler')
     def assign_try_scheduler(cls, args=None):
         '''
         This method is intended to be called from ir.cron
         args: warehouse ids [ids]
+        Each warehouse resumes from its checkpoint, the first time from the
+        previous call of the cron, and stops when the time budget of the
+        configuration is spent to continue in the next call.
         '''
         pool = Pool()
         Cron = pool.get('ir.cron')
         ModelData = pool.get('ir.model.data')
         ShipmentOut = pool.get('stock.shipment.out')
+        Location = pool.get('stock.location')
+        Checkpoint = pool.get('stock.shipment.out.assign.checkpoint')
         Configuration = Pool().get('stock.configuration')
 
         config = Configuration(1)
         cron = Cron(ModelData.get_id('stock_shipment_out_autoassign',
                 'cron_shipment_out_assign_try_scheduler'))
         from_date = cron.next_call - Cron.get_delta(cron)
+        deadline = None
+        if config.assign_time_budget:
+            deadline = time.time() + config.assign_time_budget
 
         domain = [
             ('state', '=', 'waiting'),
-            ('write_date', '>=', from_date),
             ]
         if args:
-            domain.append(
-                ('id', 'in', args),
-                )
-
-        with Transaction().set_context(dblock=False):
-            shipments = ShipmentOut.search(domain)
-
-            logger.info(
-                'Scheduler Try Assign. Total: %s' % (len(shipments)))
-
-            while cls.stock_move_locked():
-                sleep(0.1)
-            slice_try_assign = config.slice_try_assign or len(shipments)
-            blocs = 1
-            len_ship = len(shipments)
-            for sub_shipments in grouped_slice(shipments, slice_try_assign):
-                logger.info('Start bloc %s of %s.' % (
-                        blocs, len_ship/slice_try_assign))
-                ships = ShipmentOut.browse(sub_shipments)
-                ShipmentOut.assign_try(ships)
-                Transaction().commit()
-                logger.info('End bloc %s.' % blocs)
-                blocs += 1
-            logger.info('End Scheduler Try Assign.')
+            warehouse_ids = args
+        else:
+            warehouse_ids = [w.id for w in Location.search([
+                        ('type', '=', 'warehouse'),
+                        ])]
+
+        # The stock of the warehouses never overlaps so they can be assigned
+        # independently
+        partitions = {}
+        for warehouse_id in warehouse_ids:
+            checkpoint = Checkpoint.get_checkpoint(warehouse_id, from_date)
+            total = ShipmentOut.search_count(domain + [
+                    ('warehouse', '=', warehouse_id),
+                    ('write_date', '>=', checkpoint.last_write_date),
+                    ])
+            if total:
+                partitions[warehouse_id] = total
+        logger.info('Scheduler Try Assign. Total: %s' % (
+                sum(partitions.values())))
+        # Commit the checkpoints created for the workers
+        commit()
+
+        workers = min(config.assign_workers or 1, len(partitions))
+        if workers > 1:
+            cls.assign_try_warehouses_parallel(partitions, domain, workers,
+                deadline)
+        else:
+            for warehouse_id in partitions:
+                cls.assign_try_warehouse(warehouse_id, domain,
+                    checkpoint=True, deadline=deadline)
+        logger.info('End Scheduler Try Assign.')
+
+    @classmethod
+    @recorded('scheduler')
+    def assign_try_warehouse(cls, warehouse_id, domain, checkpoint=False,
+            deadline=None):
+        '''
+        Try to assign the shipments of a warehouse matching domain by blocs,
+        committing after each bloc.
+        The shipments are read by pages and the stock loaded for the previous
+        pages is kept, so the memory does not grow with the backlog.
+        If checkpoint, the pages are read from the checkpoint of the warehouse,
+        which is saved after each page, and the run stops after the page that
+        exceeds the deadline.
+        '''
+        pool = Pool()
+        Checkpoint = pool.get('stock.shipment.out.assign.checkpoint')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        domain = domain + [
+            ('warehouse', '=', warehouse_id),
+            ('assign_blocked', '=', False),
+            ]
+        with Transaction().set_context(dblock=False), \
+                warehouse_lock([warehouse_id],
+                    config.assign_lock_timeout) as locked:
+            if not locked:
+                return
+            if checkpoint:
+                checkpoint = Checkpoint.get_checkpoint(warehouse_id)
+                checkpoint.save_progress('running')
+                pages = search_pages_after(cls, domain,
+                    config.assign_page_size, checkpoint.after)
+            else:
+                pages = ((p, None) for p in cls.search_allocation_pages(
+                        domain, config.assign_page_size))
+            ledger = cls.get_ledger()
+            for page, after in pages:
+                # Discard the shipments that can not be satisfied with the
+                # stock
+                shipments = cls.get_satisfiable(page, ledger)
+                logger.info('Warehouse %s Try Assign. Satisfiable: %s of %s'
+                    % (warehouse_id, len(shipments), len(page)))
+
+                slice_try_assign = config.slice_try_assign or len(shipments)
+                blocs = 1
+                len_ship = len(shipments)
+                for sub_shipments in grouped_slice(shipments,
+                        slice_try_assign):
+                    logger.info('Start bloc %s of %s.' % (
+                            blocs, len_ship/slice_try_assign))
+                    ships = cls.browse(sub_shipments)
+                    _, failed = cls.assign_try_bisect(ships)
+                    with phase('commit'):
+                        commit()
+                    if failed:
+                        logger.info('Skipped shipments %s.' % (
+                                [s.id for s in failed]))
+                    logger.info('End bloc %s.' % blocs)
+                    blocs += 1
+
+                if checkpoint:
+                    if deadline and time.time() > deadline:
+                        checkpoint.save_progress('paused', after)
+                        logger.info('Warehouse %s Try Assign paused.'
+                            % warehouse_id)
+                        with phase('commit'):
+                            commit()
+                        return
+                    checkpoint.save_progress('running', after)
+                    with phase('commit'):
+                        commit()
+            if checkpoint:
+                checkpoint.save_progress('done')
+
+    @classmethod
+    def assign_try_warehouses_parallel(cls, partitions, domain, workers,
+            deadline=None):
+        '''
+        Try to assign the shipments of each warehouse in a pool of threads,
+        each one with its own transaction.
+        partitions: {warehouse id: number of shipments}
+        '''
+        transaction = Transaction()
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        # Balance the workers starting with the largest warehouses
+        loads = [[] for _ in range(workers)]
+        for warehouse_id in sorted(partitions,
+                key=lambda w: partitions[w], reverse=True):
+            load = min(loads,
+                key=lambda l: sum(partitions[w] for w in l))
+            load.append(warehouse_id)
+
+        def worker(warehouse_ids):
+            with Transaction().start(database_name, user, context=context):
+                ShipmentOut = Pool().get('stock.shipment.out')
+                for warehouse_id in warehouse_ids:
+                    try:
+                        ShipmentOut.assign_try_warehouse(warehouse_id,
+                            domain, checkpoint=True, deadline=deadline)
+                        # Commit the run recorded
+                        commit()
+                    except Exception:
+                        logger.error('Error assigning warehouse %s.',
+                            warehouse_id, exc_info=True)
+                        rollback()
+
+        threads = [threading.Thread(target=worker, args=(warehouse_ids,))
+            for warehouse_ids in loads if warehouse_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
 
 class ShipmentOutAssignWizardStart(ModelView):
@@ -173,6 +674,9 @@ class ShipmentOutAssignWizardStart(ModelView):
     warehouse = fields.Many2One('stock.location', 'Warehouse',
         domain=[('type', '=', 'warehouse')], required=True)
     from_datetime = fields.DateTime('From Date & Time', required=True)
+    simulate = fields.Boolean('Simulate',
+        help="Store the shipments that can be assigned in a plan to apply "
+        "later instead of listing them.")
 
     @classmethod
     def default_warehouse(cls):
@@ -194,26 +698,67 @@ class ShipmentOutAssignWizard(Wizard):
         'stock_shipment_out_autoassign.'
         'stock_shipment_out_assign_wizard_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Next', 'assign', 'tryton-go-next', default=True),
+            Button('Next', 'choose', 'tryton-go-next', default=True),
             ])
+    choose = StateTransition()
     assign = StateAction('stock_shipment_out_autoassign'
         '.act_shipment_out_autoassign')
+    plan = StateAction('stock_shipment_out_autoassign'
+        '.act_shipment_out_assign_plan')
 
-    def do_assign(self, action):
-        ShipmentOut = Pool().get('stock.shipment.out')
+    def transition_choose(self):
+        if self.start.simulate:
+            return 'plan'
+        return 'assign'
 
-        shipments = ShipmentOut.search([
+    def get_assignable(self, plan=None):
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+
+        config = Configuration(1)
+        domain = [
             ('state', 'in', ['waiting']),
             ('warehouse', '=', self.start.warehouse),
             ('write_date', '>=', self.start.from_datetime),
-            ], order=[('create_date', 'ASC')])
+            ('assign_blocked', '=', False),
+            ]
+        # Read the shipments by pages carrying the stock between them
+        ledger = ShipmentOut.get_ledger(with_childs=False,
+            stock_assign=False, deduct_reserved=True)
+        shipment_ids = []
+        for shipments in ShipmentOut.search_allocation_pages(domain,
+                config.assign_page_size):
+            shipment_ids.extend(s.id for s in
+                ShipmentOut.get_assignable(shipments, ledger, plan))
+        return shipment_ids
+
+    @recorded('wizard')
+    def do_assign(self, action):
+        shipment_ids = self.get_assignable()
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('id', 'in', shipment_ids),
+                ])
+        return action, {}
 
-        shipments = ShipmentOut.get_assignable(shipments)
+    def transition_assign(self):
+        return 'end'
 
+    @recorded('wizard')
+    def do_plan(self, action):
+        Plan = Pool().get('stock.shipment.out.assign.plan')
+
+        lines = []
+        self.get_assignable(lines)
+        plan, = Plan.create([{
+                    'warehouse': self.start.warehouse.id,
+                    'from_datetime': self.start.from_datetime,
+                    'lines': [('create', lines)],
+                    }])
         action['pyson_domain'] = PYSONEncoder().encode([
-                ('id', 'in', [s.id for s in shipments]),
+                ('id', '=', plan.id),
                 ])
         return action, {}
 
-    def transition_assign(self):
+    def transition_plan(self):
         return 'end'
@@ -0,0 +1,332 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the autoassign module.
+
+    python -m trytond.modules.stock_shipment_out_autoassign.tests.benchmark \\
+        strategies
+    python -m trytond.modules.stock_shipment_out_autoassign.tests.benchmark \\
+        database --warehouses 2 --products 50 --depth 3 --shipments 500
+
+The database benchmark uses the test database set by TRYTOND_DATABASE_URI
+and DB_NAME (SQLite in memory by default). Results are printed as JSON so
+they can be compared against a baseline.
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import random
+import time
+from decimal import Decimal
+
+from trytond.modules.stock_shipment_out_autoassign.availability import (
+    Candidate, Ledger, STRATEGIES, allocate)
+
+
+def generate_candidates(shipments, products, seed):
+    'Returns candidates and stock with a shortage of about half the demand'
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    candidates = []
+    demand = {}
+    for shipment_id in range(1, shipments + 1):
+        requirements = {}
+        for _ in range(rng.randint(1, 5)):
+            key = (1, rng.randint(1, products))
+            quantity = rng.choice([1, 1, 2, 5, 10, 50])
+            requirements[key] = requirements.get(key, 0) + quantity
+            demand[key] = demand.get(key, 0) + quantity
+        candidates.append(Candidate(shipment_id,
+                today + datetime.timedelta(days=rng.randint(0, 30)),
+                rng.randint(0, 3), requirements))
+    stock = dict((k, int(q * rng.uniform(0.2, 0.8)))
+        for k, q in demand.items())
+    return candidates, stock
+
+
+def benchmark_strategies(shipments, products, seed):
+    candidates, stock = generate_candidates(shipments, products, seed)
+    results = []
+    for name, strategy in sorted(STRATEGIES.items()):
+        start = time.time()
+        allocated = allocate(candidates, Ledger(stock), strategy)
+        results.append({
+                'strategy': name,
+                'candidates': len(candidates),
+                'served': len(allocated),
+                'seconds': time.time() - start,
+                })
+    return results
+
+
+class CountingCursor(object):
+    'Cursor proxy counting the statements executed'
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class CountingConnection(object):
+    'Connection proxy returning counting cursors'
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(
+            self._connection.cursor(*args, **kwargs), self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def measure(name, func, *args, **kwargs):
+    'Returns the wall time and number of statements of calling func'
+    from trytond.transaction import Transaction
+
+    transaction = Transaction()
+    counter = [0]
+    connection = transaction.connection
+    transaction.connection = CountingConnection(connection, counter)
+    start = time.time()
+    try:
+        func(*args, **kwargs)
+    finally:
+        transaction.connection = connection
+    return {
+        'name': name,
+        'seconds': time.time() - start,
+        'statements': counter[0],
+        }
+
+
+def create_locations(warehouses, depth):
+    'Returns the warehouses with a storage tree of depth levels'
+    from trytond.pool import Pool
+
+    Location = Pool().get('stock.location')
+    result = []
+    for i in range(warehouses):
+        input_, output, storage = Location.create([{
+                    'name': '%s %s' % (name, i),
+                    'type': 'storage',
+                    } for name in ('Input', 'Output', 'Storage')])
+        warehouse, = Location.create([{
+                    'name': 'Warehouse %s' % i,
+                    'type': 'warehouse',
+                    'input_location': input_.id,
+                    'output_location': output.id,
+                    'storage_location': storage.id,
+                    }])
+        Location.write([input_, output, storage], {'parent': warehouse.id})
+        parent = storage
+        for level in range(depth):
+            parent, = Location.create([{
+                        'name': 'Level %s %s' % (i, level),
+                        'type': 'storage',
+                        'parent': parent.id,
+                        }])
+        result.append(warehouse)
+    return result
+
+
+def create_products(products):
+    from trytond.pool import Pool
+
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(1),
+                'default_uom': unit.id,
+                'products': [('create', [{}])],
+                } for i in range(products)])
+    return [p for t in templates for p in t.products]
+
+
+def create_shipments(company, customer, warehouses, products, shipments,
+        rng):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool()
+    ShipmentOut = pool.get('stock.shipment.out')
+    Location = pool.get('stock.location')
+
+    customer_location, = Location.search([('type', '=', 'customer')])
+    today = datetime.date.today()
+    values = []
+    for i in range(shipments):
+        warehouse = rng.choice(warehouses)
+        planned_date = today + datetime.timedelta(days=rng.randint(0, 30))
+        values.append({
+                'company': company.id,
+                'customer': customer.id,
+                'delivery_address': customer.addresses[0].id,
+                'warehouse': warehouse.id,
+                'planned_date': planned_date,
+                'outgoing_moves': [('create', [{
+                                'product': product.id,
+                                'uom': product.default_uom.id,
+                                'quantity': rng.randint(1, 10),
+                                'from_location': warehouse.output_location.id,
+                                'to_location': customer_location.id,
+                                'planned_date': planned_date,
+                                'company': company.id,
+                                'unit_price': Decimal(1),
+                                'currency': company.currency.id,
+                                } for product in rng.sample(products,
+                                    min(len(products), rng.randint(1, 3)))
+                            ])],
+                })
+    shipments = ShipmentOut.create(values)
+    with Transaction().set_context(assign_try=False):
+        ShipmentOut.wait(shipments)
+    return shipments
+
+
+def receive(company, supplier, warehouses, products, rng):
+    '''
+    Returns the done inventory moves of supplier shipments bringing stock to
+    the storage locations
+    '''
+    from trytond.pool import Pool
+
+    pool = Pool()
+    ShipmentIn = pool.get('stock.shipment.in')
+    Location = pool.get('stock.location')
+
+    supplier_location, = Location.search([('type', '=', 'supplier')])
+    today = datetime.date.today()
+    shipments = ShipmentIn.create([{
+                'company': company.id,
+                'supplier': supplier.id,
+                'warehouse': warehouse.id,
+                'planned_date': today,
+                'incoming_moves': [('create', [{
+                                'product': product.id,
+                                'uom': product.default_uom.id,
+                                'quantity': rng.randint(1, 50),
+                                'from_location': supplier_location.id,
+                                'to_location': warehouse.input_location.id,
+                                'planned_date': today,
+                                'company': company.id,
+                                'unit_price': Decimal(1),
+                                'currency': company.currency.id,
+                                } for product in products])],
+                } for warehouse in warehouses])
+    ShipmentIn.receive(shipments)
+    ShipmentIn.done(shipments)
+    return [m for s in shipments for m in s.inventory_moves]
+
+
+def benchmark_database(warehouses, products, depth, shipments, seed):
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+    from trytond.tests.test_tryton import (install_module, DB_NAME, USER,
+        CONTEXT)
+    from trytond.modules.company.tests import create_company, set_company
+
+    install_module('stock_shipment_out_autoassign')
+    rng = random.Random(seed)
+    results = []
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+        Wizard = pool.get('stock.shipment.out.assign.wizard', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            config = Configuration(1)
+            # Stock is received without assigning to measure it after
+            config.autoassign_mode = 'deferred'
+            config.save()
+            customer, supplier = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }, {
+                        'name': 'Supplier',
+                        }])
+            warehouse_locations = create_locations(warehouses, depth)
+            product_list = create_products(products)
+            create_shipments(company, customer, warehouse_locations,
+                product_list, shipments, rng)
+            moves = receive(company, supplier, warehouse_locations,
+                product_list, rng)
+            config.autoassign_mode = 'immediate'
+            config.save()
+
+            waiting = ShipmentOut.search([('state', '=', 'waiting')])
+            results.append(measure('get_assignable',
+                    ShipmentOut.get_assignable, waiting))
+
+            session_id, _, _ = Wizard.create()
+            wizard = Wizard(session_id)
+            wizard.start.warehouse = warehouse_locations[0]
+            wizard.start.from_datetime = datetime.datetime.min
+            results.append(measure('do_assign', wizard.do_assign, {}))
+
+            cursor = Transaction().connection.cursor()
+            cursor.execute('SAVEPOINT benchmark')
+            results.append(measure('autoassign_out_moves',
+                    Move.autoassign_out_moves, [m.id for m in moves]))
+            cursor.execute('ROLLBACK TO SAVEPOINT benchmark')
+            Transaction().cache.clear()
+
+            # The scheduler commits so it is the last one
+            results.append(measure('assign_try_scheduler',
+                    ShipmentOut.assign_try_scheduler))
+        Transaction().rollback()
+    for result in results:
+        result.update({
+                'warehouses': warehouses,
+                'products': products,
+                'depth': depth,
+                'shipments': shipments,
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['strategies', 'database'])
+    parser.add_argument('--warehouses', type=int, default=2)
+    parser.add_argument('--products', type=int, default=None)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--shipments', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    if options.benchmark == 'strategies':
+        results = benchmark_strategies(options.shipments or 20000,
+            options.products or 500, options.seed)
+    else:
+        results = benchmark_database(options.warehouses,
+            options.products or 50, options.depth, options.shipments or 500,
+            options.seed)
+    print(json.dumps({options.benchmark: results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,895 @@
 # copyright notices and license terms.
 import unittest
 import doctest
+import datetime
+import time
+from contextlib import contextmanager
+from decimal import Decimal
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond import backend
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_shipment_out_autoassign.tools import (savepoint,
+    products_by_location, memoized)
+
+
+@contextmanager
+def patch_classmethod(Model, name, function):
+    'Replace the class method name of Model by function in the block'
+    saved = Model.__dict__.get(name)
+    setattr(Model, name, classmethod(function))
+    try:
+        yield
+    finally:
+        if saved is None:
+            delattr(Model, name)
+        else:
+            setattr(Model, name, saved)
+
+
+def failing_assign_try(ShipmentOut, shipment):
+    'Make the assign try of the shipment raise an error in the block'
+    assign_try = ShipmentOut.assign_try.__func__
+
+    def failing(cls, shipments):
+        if shipment in shipments:
+            raise Exception('Assign error')
+        return assign_try(cls, shipments)
+    return patch_classmethod(ShipmentOut, 'assign_try', failing)
+
+
+@contextmanager
+def without_commit():
+    '''
+    Keep the commits and rollbacks of the assign processes in the block out
+    of the database, so the test transaction is rolled back as a whole
+    '''
+    transaction = Transaction()
+    transaction.commit = transaction.rollback = lambda: None
+    try:
+        yield
+    finally:
+        del transaction.commit, transaction.rollback
+
+
+def create_warehouse(name):
+    'Returns a new warehouse with its input, output and storage locations'
+    Location = Pool().get('stock.location')
+    input_, output, storage = Location.create([{
+                'name': '%s %s' % (name, type_),
+                'type': 'storage',
+                } for type_ in ('Input', 'Output', 'Storage')])
+    warehouse, = Location.create([{
+                'name': name,
+                'type': 'warehouse',
+                'input_location': input_.id,
+                'output_location': output.id,
+                'storage_location': storage.id,
+                }])
+    Location.write([input_, output, storage], {'parent': warehouse.id})
+    return warehouse
+
+
+def create_product(name):
+    pool = Pool()
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(1),
+                'default_uom': unit.id,
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    return product
+
+
+def create_customer():
+    Party = Pool().get('party.party')
+    customer, = Party.create([{
+                'name': 'Customer',
+                'addresses': [('create', [{}])],
+                }])
+    return customer
+
+
+def create_supplier():
+    Party = Pool().get('party.party')
+    supplier, = Party.create([{
+                'name': 'Supplier',
+                }])
+    return supplier
+
+
+def receive(company, warehouse, product, quantity, lot=None):
+    'Returns the done move bringing quantity of product to the storage'
+    pool = Pool()
+    Move = pool.get('stock.move')
+    Location = pool.get('stock.location')
+    Date = pool.get('ir.date')
+
+    supplier, = Location.search([('type', '=', 'supplier')])
+    move, = Move.create([{
+                'product': product.id,
+                'uom': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier.id,
+                'to_location': warehouse.storage_location.id,
+                'effective_date': Date.today(),
+                'company': company.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                }])
+    if lot:
+        Move.write([move], {'lot': lot.id})
+    Move.do([move])
+    return move
+
+
+def receive_shipment(company, supplier, warehouse, quantities):
+    '''
+    Returns the done supplier shipment of the (product, quantity) pairs to
+    the warehouse
+    '''
+    pool = Pool()
+    ShipmentIn = pool.get('stock.shipment.in')
+    Location = pool.get('stock.location')
+    Date = pool.get('ir.date')
+
+    supplier_location, = Location.search([('type', '=', 'supplier')])
+    today = Date.today()
+    shipment, = ShipmentIn.create([{
+                'company': company.id,
+                'supplier': supplier.id,
+                'warehouse': warehouse.id,
+                'planned_date': today,
+                'incoming_moves': [('create', [{
+                                'product': product.id,
+                                'uom': product.default_uom.id,
+                                'quantity': quantity,
+                                'from_location': supplier_location.id,
+                                'to_location': warehouse.input_location.id,
+                                'planned_date': today,
+                                'effective_date': today,
+                                'company': company.id,
+                                'unit_price': Decimal(1),
+                                'currency': company.currency.id,
+                                } for product, quantity in quantities])],
+                }])
+    ShipmentIn.receive([shipment])
+    ShipmentIn.done([shipment])
+    return shipment
+
+
+def create_shipment(company, customer, warehouse, quantities,
+        planned_date=None):
+    '''
+    Returns a waiting shipment of the (product, quantity) pairs, without
+    trying to assign it
+    '''
+    pool = Pool()
+    ShipmentOut = pool.get('stock.shipment.out')
+    Location = pool.get('stock.location')
+    Date = pool.get('ir.date')
+
+    customer_location, = Location.search([('type', '=', 'customer')])
+    planned_date = planned_date or Date.today()
+    shipment, = ShipmentOut.create([{
+                'company': company.id,
+                'customer': customer.id,
+                'delivery_address': customer.addresses[0].id,
+                'warehouse': warehouse.id,
+                'planned_date': planned_date,
+                'outgoing_moves': [('create', [{
+                                'product': product.id,
+                                'uom': product.default_uom.id,
+                                'quantity': quantity,
+                                'from_location': warehouse.output_location.id,
+                                'to_location': customer_location.id,
+                                'planned_date': planned_date,
+                                'company': company.id,
+                                'unit_price': Decimal(1),
+                                'currency': company.currency.id,
+                                } for product, quantity in quantities])],
+                }])
+    with Transaction().set_context(assign_try=False):
+        ShipmentOut.wait([shipment])
+    return shipment
 
 
 class StockShipmentOutAutoassignTestCase(ModuleTestCase):
     'Test Stock Shipment Out Autoassign module'
     module = 'stock_shipment_out_autoassign'
 
+    @unittest.skipIf(backend.name() != 'postgresql',
+        'Shipment indexes are only created on PostgreSQL')
+    @with_transaction()
+    def test_shipment_join_index(self):
+        'Test shipment joins use an index instead of scanning moves'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+        cursor = Transaction().connection.cursor()
+
+        move = Move.__table__()
+        shipment = ShipmentOut.__table__()
+        query = move.join(shipment, condition=Move.shipment_join_condition(
+                move, shipment, 'stock.shipment.out')).select(move.id,
+            where=shipment.state == 'assigned')
+        sql, params = tuple(query)
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        cursor.execute('EXPLAIN ' + sql, params)
+        plan = '\n'.join(r[0] for r in cursor.fetchall())
+        self.assertNotIn('Seq Scan on stock_move', plan)
+        self.assertIn('stock_move_shipment_out_id_index', plan)
+
+    @with_transaction()
+    def test_assign_try_bisect(self):
+        'Test bisection isolates the shipments that can not be assigned'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Bisect')
+            product1 = create_product('Product 1')
+            product2 = create_product('Product 2')
+            receive(company, warehouse, product1, 15)
+            customer = create_customer()
+            shipment1, shipment2, shipment3 = [create_shipment(company,
+                    customer, warehouse, quantities) for quantities in [
+                    [(product1, 5)],
+                    [(product1, 5), (product2, 5)],
+                    [(product1, 5)],
+                    ]]
+
+            assigned, failed = ShipmentOut.assign_try_bisect(
+                [shipment1, shipment2, shipment3])
+
+            self.assertEqual([s.id for s in assigned],
+                [shipment1.id, shipment3.id])
+            self.assertEqual([s.id for s in failed], [shipment2.id])
+            shipment1, shipment2, shipment3 = ShipmentOut.browse(
+                [shipment1.id, shipment2.id, shipment3.id])
+            self.assertEqual([s.state for s in (shipment1, shipment2,
+                        shipment3)], ['assigned', 'waiting', 'assigned'])
+            # The blocs were rolled back but the failing shipment tried alone
+            # keeps the move it could assign
+            self.assertEqual(
+                sorted((m.product.id, m.state)
+                    for m in shipment2.inventory_moves),
+                sorted([(product1.id, 'assigned'), (product2.id, 'draft')]))
+            self.assertEqual(shipment2.assign_blocked, True)
+            self.assertEqual(shipment3.assign_blocked, False)
+
+    @with_transaction()
+    def test_assign_try_bisect_error(self):
+        'Test bisection does not block the shipments raising an error'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Bisect Error')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            shipment1, shipment2 = [create_shipment(company, customer,
+                    warehouse, [(product, 5)]) for _ in range(2)]
+
+            with failing_assign_try(ShipmentOut, shipment1):
+                assigned, failed = ShipmentOut.assign_try_bisect(
+                    [shipment1, shipment2])
+
+            self.assertEqual([s.id for s in assigned], [shipment2.id])
+            self.assertEqual([s.id for s in failed], [shipment1.id])
+            shipment1, shipment2 = ShipmentOut.browse(
+                [shipment1.id, shipment2.id])
+            self.assertEqual(shipment1.state, 'waiting')
+            self.assertEqual(
+                [m.state for m in shipment1.inventory_moves], ['draft'])
+            self.assertEqual(shipment1.assign_blocked, False)
+            self.assertEqual(shipment2.state, 'assigned')
+
+    @with_transaction()
+    def test_assign_try_bisect_unblock(self):
+        'Test the shipments blocked by a shipment not assigned are unblocked'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Bisect Unblock')
+            product = create_product('Product')
+            receive(company, warehouse, product, 5)
+            customer = create_customer()
+            shipment1, shipment2 = [create_shipment(company, customer,
+                    warehouse, [(product, 5)]) for _ in range(2)]
+
+            # The stock is allocated to the first shipment
+            satisfiable = ShipmentOut.get_satisfiable([shipment1, shipment2])
+            self.assertEqual([s.id for s in satisfiable], [shipment1.id])
+            self.assertEqual(ShipmentOut(shipment2.id).assign_blocked, True)
+
+            with failing_assign_try(ShipmentOut, shipment1):
+                ShipmentOut.assign_try_bisect(satisfiable)
+
+            self.assertEqual(ShipmentOut(shipment2.id).assign_blocked, False)
+
+    @with_transaction()
+    def test_assign_try_warehouse_checkpoint(self):
+        'Test the scheduler pauses at the deadline and resumes from there'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Checkpoint = pool.get('stock.shipment.out.assign.checkpoint')
+        Configuration = pool.get('stock.configuration')
+
+        company = create_company()
+        with set_company(company):
+            config = Configuration(1)
+            config.assign_page_size = 1
+            config.save()
+            warehouse = create_warehouse('Checkpoint')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            shipment1, shipment2 = [create_shipment(company, customer,
+                    warehouse, [(product, 5)]) for _ in range(2)]
+            domain = [('state', '=', 'waiting')]
+
+            # The deadline is already exceeded after the first page
+            with without_commit():
+                ShipmentOut.assign_try_warehouse(warehouse.id, domain,
+                    checkpoint=True, deadline=time.time() - 1)
+
+            checkpoint = Checkpoint.get_checkpoint(warehouse.id)
+            self.assertEqual(checkpoint.state, 'paused')
+            self.assertEqual(checkpoint.last_id, shipment1.id)
+            self.assertEqual([s.state for s in ShipmentOut.browse(
+                        [shipment1.id, shipment2.id])],
+                ['assigned', 'waiting'])
+
+            with without_commit():
+                ShipmentOut.assign_try_warehouse(warehouse.id, domain,
+                    checkpoint=True)
+
+            checkpoint = Checkpoint(checkpoint.id)
+            self.assertEqual(checkpoint.state, 'done')
+            self.assertEqual(checkpoint.last_id, shipment2.id)
+            self.assertEqual([s.state for s in ShipmentOut.browse(
+                        [shipment1.id, shipment2.id])],
+                ['assigned', 'assigned'])
+
+    @with_transaction()
+    def test_products_by_location_memo(self):
+        'Test the memoized quantities are forgotten when the stock changes'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Memo')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            shipment = create_shipment(company, customer, warehouse,
+                [(product, 4)])
+            move, = shipment.inventory_moves
+            key = (warehouse.storage_location.id, product.id)
+            self.assertFalse(memoized())
+
+            def quantity(stock_assign):
+                with Transaction().set_context(forecast=False,
+                        stock_assign=stock_assign,
+                        stock_date_end=Date.today()):
+                    return products_by_location([key[0]], [key[1]],
+                        with_childs=True).get(key, 0)
+            self.assertEqual(quantity(True), 10)
+            self.assertEqual(quantity(False), 10)
+            self.assertTrue(memoized())
+
+            Move.assign([move])
+            self.assertEqual(quantity(True), 6)
+            self.assertEqual(quantity(False), 10)
+
+            Move.draft([move])
+            self.assertEqual(quantity(True), 10)
+
+            Move.assign([move])
+            Move.do([move])
+            self.assertEqual(quantity(False), 6)
+
+            # The quantities read in a savepoint rolled back are forgotten
+            with self.assertRaises(ValueError):
+                with savepoint():
+                    receive(company, warehouse, product, 5)
+                    self.assertEqual(quantity(False), 11)
+                    raise ValueError
+            self.assertEqual(quantity(False), 6)
+
+    @with_transaction()
+    def test_get_assignable_parity(self):
+        'Test get_assignable finds the shipments of the record based fit'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Product = pool.get('product.product')
+        Location = pool.get('stock.location')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            today = Date.today()
+            warehouse = create_warehouse('Parity')
+            products = [create_product('Product %s' % i) for i in range(3)]
+            for product, quantity in zip(products, [12, 7, 0]):
+                if quantity:
+                    receive(company, warehouse, product, quantity)
+            customer = create_customer()
+            shipments = [create_shipment(company, customer, warehouse,
+                    quantities, today + datetime.timedelta(days=days))
+                for days, quantities in [
+                    (0, [(products[0], 5), (products[1], 3)]),
+                    (1, [(products[0], 4)]),
+                    (1, [(products[1], 4)]),
+                    (2, [(products[0], 2), (products[2], 1)]),
+                    (3, [(products[0], 3)]),
+                    (3, [(products[1], 1), (products[0], 1)]),
+                    ]]
+            shipments = ShipmentOut.browse([s.id for s in shipments])
+
+            # The fit over the records of the moves that get_assignable
+            # reads in bulk
+            locations = set(m.from_location
+                for s in shipments for m in s.inventory_moves)
+            location_ids = [l.id for l in Location.search([
+                        ('parent', 'child_of', [l.id for l in locations]),
+                        ])]
+            with Transaction().set_context(forecast=False,
+                    stock_date_end=today):
+                pbl = Product.products_by_location(location_ids,
+                    [p.id for p in products], with_childs=False)
+            expected = []
+            for shipment in shipments:
+                for move in shipment.inventory_moves:
+                    key = (move.from_location.id, move.product.id)
+                    if key not in pbl or move.quantity >= pbl[key]:
+                        break
+                else:
+                    for move in shipment.inventory_moves:
+                        pbl[(move.from_location.id, move.product.id)] -= (
+                            move.quantity)
+                    expected.append(shipment.id)
+
+            self.assertEqual(
+                [s.id for s in ShipmentOut.get_assignable(shipments)],
+                expected)
+            self.assertTrue(expected)
+
+    @with_transaction()
+    def test_autoassign_partial(self):
+        'Test the partial policy splits the moves served by a receipt'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
+
+        company = create_company()
+        with set_company(company):
+            config = Configuration(1)
+            config.partial_assign_policy = 'partial'
+            config.save()
+            warehouse = create_warehouse('Partial')
+            product1 = create_product('Product 1')
+            product2 = create_product('Product 2')
+            customer = create_customer()
+            supplier = create_supplier()
+            shipment = create_shipment(company, customer, warehouse,
+                [(product1, 10), (product2, 2)])
+
+            receive_shipment(company, supplier, warehouse,
+                [(product1, 4), (product2, 5)])
+
+            shipment = ShipmentOut(shipment.id)
+            self.assertEqual(shipment.state, 'waiting')
+            self.assertEqual(
+                sorted((m.product.id, m.quantity, m.state)
+                    for m in shipment.inventory_moves),
+                sorted([
+                        (product1.id, 4, 'assigned'),
+                        (product1.id, 6, 'draft'),
+                        (product2.id, 2, 'assigned'),
+                        ]))
+
+    @unittest.skipIf(backend.name() != 'postgresql',
+        'The single query uses window functions of PostgreSQL')
+    @with_transaction()
+    def test_out_moves_to_assign_query_parity(self):
+        'Test the single query finds the moves of the Python fit'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Blocked = pool.get('stock.shipment.out.assign.blocked')
+        Configuration = pool.get('stock.configuration')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            today = Date.today()
+            config = Configuration(1)
+            # The received moves are computed below without assigning
+            config.autoassign_mode = 'deferred'
+            config.save()
+            warehouse = create_warehouse('Query')
+            storage = warehouse.storage_location
+            product1 = create_product('Product 1')
+            product2 = create_product('Product 2')
+            customer = create_customer()
+            supplier = create_supplier()
+
+            # Already assigned shipment reserving stock
+            receive(company, warehouse, product1, 3)
+            reserving = create_shipment(company, customer, warehouse,
+                [(product1, 3)])
+            self.assertTrue(ShipmentOut.assign_try([reserving]))
+
+            shipments = [create_shipment(company, customer, warehouse,
+                    quantities, today + datetime.timedelta(days=days))
+                for days, quantities in [
+                    (-1, [(product1, 1)]),
+                    (0, [(product1, 5), (product2, 2)]),
+                    (1, [(product1, 2), (product2, 4)]),
+                    (2, [(product1, 1)]),
+                    ]]
+            blocked, whole, lacking, other = ShipmentOut.browse(
+                [s.id for s in shipments])
+
+            receipt = receive_shipment(company, supplier, warehouse,
+                [(product1, 8), (product2, 5)])
+            Blocked.block({blocked.id: {(storage.id, product1.id): 1}})
+            move_ids = [m.id for m in receipt.inventory_moves]
+
+            to_assign, _ = Move.get_out_moves_to_assign(move_ids)
+            self.assertEqual(
+                sorted(Move.get_out_moves_to_assign_query(move_ids)),
+                sorted(to_assign))
+            self.assertEqual(sorted(to_assign),
+                sorted(m.id for s in (whole, other)
+                    for m in s.inventory_moves))
+
+    @unittest.skipIf(backend.name() != 'postgresql',
+        'The single query uses window functions of PostgreSQL')
+    @with_transaction()
+    def test_out_moves_to_assign_query_running_demand(self):
+        'Test a move not served by the single query starves the next ones'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Configuration = pool.get('stock.configuration')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            today = Date.today()
+            config = Configuration(1)
+            config.autoassign_mode = 'deferred'
+            config.save()
+            warehouse = create_warehouse('Running Demand')
+            product = create_product('Product')
+            customer = create_customer()
+            supplier = create_supplier()
+            create_shipment(company, customer, warehouse, [(product, 20)],
+                today)
+            small = create_shipment(company, customer, warehouse,
+                [(product, 1)], today + datetime.timedelta(days=1))
+
+            receipt = receive_shipment(company, supplier, warehouse,
+                [(product, 5)])
+            move_ids = [m.id for m in receipt.inventory_moves]
+
+            # The Python fit skips the first shipment but the running demand
+            # of the query already exceeds the stock
+            to_assign, _ = Move.get_out_moves_to_assign(move_ids)
+            self.assertEqual(to_assign,
+                [m.id for m in small.inventory_moves])
+            self.assertEqual(Move.get_out_moves_to_assign_query(move_ids),
+                [])
+
+
+    @with_transaction()
+    def test_job_process_failed(self):
+        'Test a job raising an error fails without stopping the next ones'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Job = pool.get('stock.shipment.out.assign.job')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Job')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            failing, other = [create_shipment(company, customer, warehouse,
+                    [(product, 5)]) for _ in range(2)]
+            failing_job = Job.submit([failing])
+            other_job = Job.submit([other])
+
+            get_satisfiable = ShipmentOut.get_satisfiable.__func__
+
+            def get_satisfiable_error(cls, shipments, ledger=None):
+                if failing in shipments:
+                    raise Exception('Satisfiable error')
+                return get_satisfiable(cls, shipments, ledger)
+            with without_commit(), patch_classmethod(ShipmentOut,
+                    'get_satisfiable', get_satisfiable_error):
+                Job.process()
+
+            failing_job, other_job = Job.browse(
+                [failing_job.id, other_job.id])
+            self.assertEqual(failing_job.state, 'failed')
+            self.assertEqual(other_job.state, 'done')
+            self.assertEqual(other_job.assigned, 1)
+            self.assertEqual(ShipmentOut(other.id).state, 'assigned')
+
+    @with_transaction()
+    def test_try_assign_background(self):
+        'Test the try assign of many shipments opens the submitted job'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Job = pool.get('stock.shipment.out.assign.job')
+        ModelData = pool.get('ir.model.data')
+        Configuration = pool.get('stock.configuration')
+
+        company = create_company()
+        with set_company(company):
+            config = Configuration(1)
+            config.try_assign_background = 2
+            config.save()
+            warehouse = create_warehouse('Background')
+            product = create_product('Product')
+            customer = create_customer()
+            shipments = [create_shipment(company, customer, warehouse,
+                    [(product, 1)]) for _ in range(2)]
+
+            action = ShipmentOut.try_assign(shipments)
+
+            self.assertEqual(action, ModelData.get_id(
+                    'stock_shipment_out_autoassign',
+                    'act_shipment_out_assign_job'))
+            job, = Job.search([('shipments', 'in', [shipments[0].id])])
+            self.assertEqual(job.state, 'pending')
+            self.assertEqual(sorted(s.id for s in job.shipments),
+                sorted(s.id for s in shipments))
+
+
+    @with_transaction()
+    def test_pending_process(self):
+        'Test the stock increases are queued and drained by the scheduler'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Pending = pool.get('stock.shipment.out.assign.pending')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Pending')
+            product = create_product('Product')
+            other_product = create_product('Other Product')
+            customer = create_customer()
+            shipment = create_shipment(company, customer, warehouse,
+                [(product, 5)])
+
+            receive(company, warehouse, product, 10)
+            self.assertEqual(
+                [(p.warehouse, p.product) for p in Pending.search([])],
+                [(warehouse, product)])
+
+            assign_try_warehouse = ShipmentOut.assign_try_warehouse.__func__
+
+            def receive_meanwhile(cls, warehouse_id, domain, **kwargs):
+                receive(company, warehouse, other_product, 1)
+                return assign_try_warehouse(cls, warehouse_id, domain,
+                    **kwargs)
+            with without_commit(), patch_classmethod(ShipmentOut,
+                    'assign_try_warehouse', receive_meanwhile):
+                Pending.process()
+
+            self.assertEqual(ShipmentOut(shipment.id).state, 'assigned')
+            # The increase recorded while processing is kept for the next call
+            self.assertEqual(
+                [(p.warehouse, p.product) for p in Pending.search([])],
+                [(warehouse, other_product)])
+
+
+    @with_transaction()
+    def test_plan_apply(self):
+        'Test a plan assigns its shipments without checking unchanged stock'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Plan = pool.get('stock.shipment.out.assign.plan')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Plan')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            shipment = create_shipment(company, customer, warehouse,
+                [(product, 4)])
+            lines = []
+            ShipmentOut.get_assignable([shipment], plan=lines)
+            plan, = Plan.create([{
+                        'warehouse': warehouse.id,
+                        'lines': [('create', lines)],
+                        }])
+
+            checked = []
+            get_satisfiable = ShipmentOut.get_satisfiable.__func__
+
+            def recording(cls, shipments, ledger=None):
+                checked.extend(shipments)
+                return get_satisfiable(cls, shipments, ledger)
+            with patch_classmethod(ShipmentOut, 'get_satisfiable',
+                    recording):
+                Plan.apply([plan])
+
+            self.assertEqual(checked, [])
+            self.assertEqual(Plan(plan.id).state, 'applied')
+            self.assertEqual(ShipmentOut(shipment.id).state, 'assigned')
+
+    @with_transaction()
+    def test_plan_apply_stock_changed(self):
+        'Test a plan checks its shipments again when the stock has changed'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Plan = pool.get('stock.shipment.out.assign.plan')
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Plan Changed')
+            product = create_product('Product')
+            receive(company, warehouse, product, 10)
+            customer = create_customer()
+            shipment = create_shipment(company, customer, warehouse,
+                [(product, 4)])
+            lines = []
+            ShipmentOut.get_assignable([shipment], plan=lines)
+            plan, = Plan.create([{
+                        'warehouse': warehouse.id,
+                        'lines': [('create', lines)],
+                        }])
+
+            # The stock of the plan is lost before it is applied
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            lost, = Move.create([{
+                        'product': product.id,
+                        'uom': product.default_uom.id,
+                        'quantity': 8,
+                        'from_location': warehouse.storage_location.id,
+                        'to_location': lost_found.id,
+                        'effective_date': Date.today(),
+                        'company': company.id,
+                        }])
+            Move.do([lost])
+            self.assertNotEqual(plan.stock_version, plan.get_stock_version())
+
+            checked = []
+            get_satisfiable = ShipmentOut.get_satisfiable.__func__
+
+            def recording(cls, shipments, ledger=None):
+                checked.extend(shipments)
+                return get_satisfiable(cls, shipments, ledger)
+            with patch_classmethod(ShipmentOut, 'get_satisfiable',
+                    recording):
+                Plan.apply([plan])
+
+            self.assertEqual(checked, [shipment])
+            self.assertEqual(Plan(plan.id).state, 'applied')
+            self.assertEqual(ShipmentOut(shipment.id).state, 'waiting')
+
+
+    @with_transaction()
+    def test_get_assignable_lot_aware(self):
+        'Test the lot aware get_assignable checks the stock of the lots'
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Move = pool.get('stock.move')
+        Configuration = pool.get('stock.configuration')
+        if 'lot' not in Move._fields:
+            self.skipTest('stock_lot is not installed')
+        Lot = pool.get('stock.lot')
+
+        company = create_company()
+        with set_company(company):
+            config = Configuration(1)
+            config.assign_lot_aware = True
+            config.save()
+            warehouse = create_warehouse('Lots')
+            product = create_product('Product')
+            lot1, lot2 = Lot.create([{
+                        'number': number,
+                        'product': product.id,
+                        } for number in ['1', '2']])
+            receive(company, warehouse, product, 10, lot1)
+            customer = create_customer()
+            shipments = [create_shipment(company, customer, warehouse,
+                    [(product, 4)]) for _ in range(3)]
+            for shipment, lot in zip(shipments, [lot1, lot2, None]):
+                Move.write(list(shipment.inventory_moves), {
+                        'lot': lot.id if lot else None,
+                        })
+
+            ledger = ShipmentOut.get_ledger(with_childs=False,
+                stock_assign=False, deduct_reserved=True)
+            self.assertTrue(ledger.lot_aware)
+            assignable = ShipmentOut.get_assignable(
+                ShipmentOut.browse([s.id for s in shipments]), ledger)
+
+            # The second lot has no stock but the shipment without lot fits
+            self.assertEqual([s.id for s in assignable],
+                [shipments[0].id, shipments[2].id])
+            self.assertEqual(ledger.available(
+                    (warehouse.storage_location.id, product.id, lot1.id)), 6)
+
+    @with_transaction()
+    def test_get_reserved_quantities(self):
+        'Test the reserved quantities are aggregated by location and subtree'
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            warehouse = create_warehouse('Reserved')
+            storage = warehouse.storage_location
+            shelf, = Location.create([{
+                        'name': 'Shelf',
+                        'type': 'storage',
+                        'parent': storage.id,
+                        }])
+            customer_location, = Location.search([('type', '=', 'customer')])
+            product = create_product('Product')
+            other_product = create_product('Other Product')
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'uom': product.default_uom.id,
+                        'quantity': quantity,
+                        'from_location': from_location.id,
+                        'to_location': to_location.id,
+                        'planned_date': Date.today(),
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': company.currency.id,
+                        } for quantity, from_location, to_location in [
+                        (5, storage, customer_location),
+                        (3, shelf, customer_location),
+                        (2, shelf, storage),
+                        (7, storage, customer_location),
+                        ]])
+            Move.assign(moves[:3])
+
+            subtrees = Location.get_storage_subtrees([warehouse.id])
+            reserved = Move.get_reserved_quantities(
+                [product.id, other_product.id], location_ids=[shelf.id],
+                subtrees=subtrees)
+
+            # The draft move is not reserved and the move from the shelf to
+            # the storage stays in the subtree
+            self.assertEqual(reserved, {
+                    (storage.id, product.id): 8,
+                    (shelf.id, product.id): 5,
+                    })
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -0,0 +1,164 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from contextlib import contextmanager
+import weakref
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['savepoint', 'search_pages_after', 'keyset_after',
+    'products_by_location', 'memoized', 'forget_quantities', 'commit',
+    'rollback']
+
+# Quantities of products_by_location memoized by transaction:
+#   {transaction: {memo key: (quantities, loaded (location, product) pairs)}}
+_quantities = weakref.WeakKeyDictionary()
+# Context keys changing the quantities computed
+QUANTITY_CONTEXT = ['forecast', 'stock_date_start', 'stock_date_end',
+    'stock_assign']
+
+
+@contextmanager
+def savepoint(name='stock_shipment_out_autoassign'):
+    '''
+    Run the block in a database savepoint rolled back if it raises, so the
+    rest of the transaction can continue without commit.
+    '''
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # Records and quantities read inside the savepoint may be outdated
+        transaction.cache.clear()
+        forget_quantities()
+        raise
+    else:
+        cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
+
+def search_pages_after(Model, domain, page_size, after=None):
+    '''
+    Yield the records of Model matching domain by pages of page_size ordered
+    by (write date, id) starting after the key after. Pages are read with
+    keyset pagination so the records of a page can be modified, or
+    committed, before reading the next one. Each page is yielded with the key
+    of its last record, read before it is modified, to resume from it.
+    '''
+    while True:
+        page_domain = list(domain)
+        if after:
+            write_date, last_id = after
+            page_domain.append(['OR',
+                    ('write_date', '>', write_date),
+                    [
+                        ('write_date', '=', write_date),
+                        ('id', '>', last_id),
+                        ],
+                    ])
+        records = Model.search(page_domain,
+            order=[('write_date', 'ASC'), ('id', 'ASC')],
+            limit=page_size or None)
+        if not records:
+            break
+        after = (records[-1].write_date, records[-1].id)
+        yield records, after
+        if not page_size or len(records) < page_size:
+            break
+
+
+def keyset_after(columns, values):
+    '''
+    Returns the SQL condition of the columns being after the values in the
+    ascending order of the columns
+    '''
+    condition = None
+    for i in reversed(range(len(columns))):
+        after = columns[i] > values[i]
+        if condition is not None:
+            after |= (columns[i] == values[i]) & condition
+        condition = after
+    return condition
+
+
+def products_by_location(location_ids, product_ids, with_childs=False,
+        grouping=('product',)):
+    '''
+    Same as Product.products_by_location but memoized in the transaction for
+    the context, so the pairs of (location, product) already computed are not
+    aggregated again. The quantities of a product are forgotten when its
+    moves are assigned, done or cancelled and all of them when the
+    transaction is committed or rolled back by this module.
+    '''
+    Product = Pool().get('product.product')
+    transaction = Transaction()
+
+    context = transaction.context
+    key = (with_childs, tuple(grouping)) + tuple(
+        context.get(k) for k in QUANTITY_CONTEXT)
+    quantities, loaded = _quantities.setdefault(transaction, {}).setdefault(
+        key, ({}, set()))
+
+    location_ids, product_ids = set(location_ids), set(product_ids)
+    missing = set((l, p) for l in location_ids for p in product_ids
+        if (l, p) not in loaded)
+    if missing:
+        missing_location_ids = set(l for l, _ in missing)
+        missing_product_ids = set(p for _, p in missing)
+        pbl = Product.products_by_location(list(missing_location_ids),
+            product_ids=list(missing_product_ids), with_childs=with_childs,
+            grouping=grouping)
+        for pair in list(quantities):
+            if pair[0] in missing_location_ids and (
+                    pair[1] in missing_product_ids):
+                del quantities[pair]
+        # Missing pairs have no stock
+        quantities.update((k, q) for k, q in pbl.items() if q)
+        loaded.update((l, p) for l in missing_location_ids
+            for p in missing_product_ids)
+    return dict((k, q) for k, q in quantities.items()
+        if k[0] in location_ids and k[1] in product_ids)
+
+
+def memoized():
+    'Returns if the transaction has quantities memoized'
+    return bool(_quantities.get(Transaction()))
+
+
+def forget_quantities(product_ids=None):
+    '''
+    Forget the quantities memoized in the transaction of the products or all
+    of them.
+    '''
+    memo = _quantities.get(Transaction())
+    if not memo:
+        return
+    if product_ids is None:
+        memo.clear()
+        return
+    product_ids = set(product_ids)
+    for quantities, loaded in memo.values():
+        for pair in [k for k in quantities if k[1] in product_ids]:
+            del quantities[pair]
+        loaded.difference_update(
+            [k for k in loaded if k[1] in product_ids])
+
+
+def commit():
+    '''
+    Commit the transaction forgetting the quantities memoized and taking again
+    the warehouse locks released
+    '''
+    # lock imports phase from assign which imports this module
+    from .lock import relock
+    forget_quantities()
+    Transaction().commit()
+    relock()
+
+
+def rollback():
+    'Roll back the transaction forgetting the quantities memoized'
+    forget_quantities()
+    Transaction().rollback()